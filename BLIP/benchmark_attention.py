@@ -0,0 +1,112 @@
+'''
+CPU speed and memory of the MED attention backends.
+
+Runs the text transformer of models/med.py with attention_backend "eager" (explicit matmul/softmax) and "sdpa"
+(torch scaled_dot_product_attention) on random weights, for the image-text matching encoder, the text-only
+encoder and the caption decoder, and reports time per batch, the peak memory the forward pass adds on top of
+the model, and the largest difference between the two outputs. Every run happens in its own process so that
+the peak resident set sizes do not carry over between backends.
+
+    python benchmark_attention.py --batch_size 32 --image_tokens 577 --threads 8
+'''
+import argparse
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+from models.med import BertConfig, BertModel, BertLMHeadModel
+
+
+def build(args, backend):
+    config = BertConfig.from_json_file(args.med_config)
+    config.encoder_width = args.vision_width
+    config.attention_backend = backend
+    torch.manual_seed(args.seed)
+    if args.mode == 'decoder':
+        model = BertLMHeadModel(config=config)
+    else:
+        model = BertModel(config=config, add_pooling_layer=False)
+    return model.train(args.backward)
+
+
+def make_inputs(args):
+    generator = torch.Generator().manual_seed(args.seed)
+    input_ids = torch.randint(1000, 30000, (args.batch_size, args.text_length), generator=generator)
+    attention_mask = torch.ones_like(input_ids)
+    # a few shorter captions so that the padding mask is exercised
+    attention_mask[::4, args.text_length // 2:] = 0
+    image_embeds = torch.randn(args.batch_size, args.image_tokens, args.vision_width, generator=generator)
+    image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long)
+    return input_ids, attention_mask, image_embeds, image_atts
+
+
+def forward(model, args, inputs):
+    input_ids, attention_mask, image_embeds, image_atts = inputs
+    if args.mode == 'decoder':
+        output = model(input_ids, attention_mask=attention_mask, encoder_hidden_states=image_embeds,
+                       encoder_attention_mask=image_atts, return_dict=True).logits
+    elif args.mode == 'text':
+        output = model(input_ids, attention_mask=attention_mask, return_dict=True, mode='text').last_hidden_state
+    else:
+        output = model(input_ids, attention_mask=attention_mask, encoder_hidden_states=image_embeds,
+                       encoder_attention_mask=image_atts, return_dict=True).last_hidden_state
+    if args.backward:
+        output.float().mean().backward()
+        model.zero_grad(set_to_none=True)
+    return output.detach()
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(args, backend):
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+    model = build(args, backend)
+    inputs = make_inputs(args)
+    base = peak_rss()
+    with torch.set_grad_enabled(args.backward):
+        output = forward(model, args, inputs)
+        memory = peak_rss() - base
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            forward(model, args, inputs)
+        elapsed = (time.perf_counter() - start) / args.repeats
+    return elapsed, memory, output[:4].clone()
+
+
+def measure(args, backend):
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(run, args, backend).result()
+
+
+def main(args):
+    print('%s, batch %d, %d text tokens, %d image tokens, %s, %d threads' % (
+        args.mode, args.batch_size, args.text_length, args.image_tokens,
+        'forward+backward' if args.backward else 'forward', args.threads or torch.get_num_threads()))
+    results = {backend: measure(args, backend) for backend in ('eager', 'sdpa')}
+    for backend, (elapsed, memory, _) in results.items():
+        print('%-6s %8.1f ms/batch   peak +%7.1f MB' % (backend, elapsed * 1000, memory))
+    eager, sdpa = results['eager'], results['sdpa']
+    print('speedup %.2fx, memory %.2fx, max abs difference %.2e' % (
+        eager[0] / sdpa[0], eager[1] / max(sdpa[1], 1e-6), (eager[2] - sdpa[2]).abs().max().item()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--med_config', default='configs/med_config.json')
+    parser.add_argument('--mode', default='multimodal', choices=['multimodal', 'text', 'decoder'])
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--text_length', default=35, type=int)
+    parser.add_argument('--image_tokens', default=577, type=int)
+    parser.add_argument('--vision_width', default=768, type=int)
+    parser.add_argument('--backward', action='store_true')
+    parser.add_argument('--repeats', default=3, type=int)
+    parser.add_argument('--seed', default=42, type=int)
+    parser.add_argument('--threads', default=0, type=int)
+    args = parser.parse_args()
+    main(args)
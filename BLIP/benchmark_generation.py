@@ -0,0 +1,108 @@
+'''
+Caption decoding speed of models/decoding.py against transformers generate().
+
+Both paths decode the same image embeddings with the same settings. The script checks that they produce the
+same token ids and reports generated tokens per second for beam search, greedy search and nucleus sampling.
+
+    python benchmark_generation.py --pretrained model_base_caption_capfilt_large.pth --image_dir fixtures/images
+'''
+import argparse
+import glob
+import os
+import time
+
+import torch
+from PIL import Image
+from torchvision import transforms
+from torchvision.transforms.functional import InterpolationMode
+
+from models.blip import blip_decoder
+from models import decoding
+
+
+def load_images(image_dir, image_size, num_images):
+    if not image_dir:
+        return torch.randn(num_images, 3, image_size, image_size)
+    transform = transforms.Compose([
+        transforms.Resize((image_size, image_size), interpolation=InterpolationMode.BICUBIC),
+        transforms.ToTensor(),
+        transforms.Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711)),
+    ])
+    paths = sorted(p for ext in ('jpg', 'jpeg', 'png') for p in glob.glob(os.path.join(image_dir, '*.' + ext)))
+    assert paths, 'no images found in %s' % image_dir
+    return torch.stack([transform(Image.open(p).convert('RGB')) for p in paths[:num_images]])
+
+
+def count_tokens(outputs, prompt_length, pad_token_id, eos_token_id):
+    # generated tokens up to and including the first [SEP]
+    total = 0
+    for output in outputs[:, prompt_length:].tolist():
+        output = [t for t in output if t != pad_token_id]
+        total += output.index(eos_token_id) + 1 if eos_token_id in output else len(output)
+    return total
+
+
+def timed(fn, seed, repeats):
+    torch.manual_seed(seed)
+    fn()  # warmup
+    start = time.perf_counter()
+    for _ in range(repeats):
+        torch.manual_seed(seed)
+        out = fn()
+    return out, (time.perf_counter() - start) / repeats
+
+
+@torch.no_grad()
+def main(args):
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+    device = torch.device(args.device)
+    model = blip_decoder(pretrained=args.pretrained, image_size=args.image_size, vit=args.vit,
+                         med_config=args.med_config).to(device).eval()
+    tokenizer = model.tokenizer
+    images = load_images(args.image_dir, args.image_size, args.batch_size).to(device)
+    image_embeds = model.visual_encoder(images)
+    image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long, device=device)
+    input_ids = model.prompt_ids(model.prompt).to(device).repeat(images.size(0), 1)
+    settings = dict(max_length=args.max_length, min_length=args.min_length, eos_token_id=tokenizer.sep_token_id,
+                    pad_token_id=tokenizer.pad_token_id)
+
+    modes = [
+        ('beam', dict(num_beams=args.num_beams, repetition_penalty=1.0)),
+        ('greedy', dict(num_beams=1, repetition_penalty=1.0)),
+        ('nucleus', dict(sample=True, top_p=0.9, repetition_penalty=1.1)),
+    ]
+    print('%d images, max_length %d, %s' % (images.size(0), args.max_length, device))
+    for name, kwargs in modes:
+        hf_kwargs = dict(kwargs)
+        if hf_kwargs.pop('sample', False):
+            hf_kwargs['do_sample'] = True
+        ref, ref_time = timed(lambda: model.text_decoder.generate(input_ids=input_ids, encoder_hidden_states=image_embeds,
+                                                                  encoder_attention_mask=image_atts, **settings,
+                                                                  **hf_kwargs),
+                              args.seed, args.repeats)
+        out, native_time = timed(lambda: decoding.generate(model.text_decoder, input_ids, image_embeds, image_atts,
+                                                           **settings, **kwargs),
+                                 args.seed, args.repeats)
+        tokens = count_tokens(out, input_ids.size(1), tokenizer.pad_token_id, tokenizer.sep_token_id)
+        same = ref.shape == out.shape and torch.equal(ref, out)
+        print('%-8s generate() %7.1f tokens/s   native %7.1f tokens/s   %.2fx   identical: %s' % (
+            name, tokens / ref_time, tokens / native_time, ref_time / native_time, same))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pretrained', default='')
+    parser.add_argument('--med_config', default='configs/med_config.json')
+    parser.add_argument('--vit', default='base')
+    parser.add_argument('--image_size', default=384, type=int)
+    parser.add_argument('--image_dir', default='')
+    parser.add_argument('--batch_size', default=8, type=int)
+    parser.add_argument('--num_beams', default=3, type=int)
+    parser.add_argument('--max_length', default=30, type=int)
+    parser.add_argument('--min_length', default=10, type=int)
+    parser.add_argument('--repeats', default=3, type=int)
+    parser.add_argument('--seed', default=42, type=int)
+    parser.add_argument('--threads', default=0, type=int)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,111 @@
+'''
+Recall-vs-memory of compressed embedding search (retrieval/quantization.py) against exact float32 search.
+
+The vectors come from .npy files (e.g. ViT CLS embeddings saved from /analyze or BGE embeddings from /embed with
+format=npy), from a field of an extract_features.py shard directory, or, with neither, from a synthetic set.
+The last --queries vectors are held out as queries and the rest form the gallery. 8-bit scalar quantization and
+product quantization with each of --subvectors are trained on up to --num_train gallery vectors, and for each the
+script reports bytes per vector, total memory (codes + codebooks), training time, search time per query (codes
+only / rescoring the last shortlist) and recall@k of the exact top-k: searching the codes alone, and rescoring a
+shortlist of each --shortlists size with the original vectors.
+
+    python benchmark_quantization.py --vectors analyze_cls.npy --normalize --subvectors 48 96 192
+    python benchmark_quantization.py --shards features/coco_test/images --field image_feats --subvectors 16 32 64
+'''
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from retrieval.quantization import ScalarQuantizer, ProductQuantizer, compress, compressed_search, train_sample
+from retrieval.shards import open_shards
+from retrieval.similarity import streaming_top_k
+
+
+def load_vectors(args):
+    if args.vectors:
+        return torch.from_numpy(np.concatenate([np.load(path) for path in args.vectors]).astype(np.float32))
+    if args.shards:
+        _, fields = open_shards(args.shards)
+        return fields[args.field][:].float()
+    # clustered rather than uniform on the sphere, as real embeddings are
+    generator = torch.Generator().manual_seed(args.seed)
+    centers = torch.randn(args.synthetic // 100, args.dim, generator=generator)
+    assignment = torch.randint(centers.size(0), (args.synthetic,), generator=generator)
+    return centers[assignment] + 0.5 * torch.randn(args.synthetic, args.dim, generator=generator)
+
+
+def recall(indices, exact):
+    # fraction of the exact top-k found in the retrieved top-k
+    return (indices[:, :, None] == exact[:, None, :]).any(dim=2).float().mean().item()
+
+
+def timed_search(search, num_queries):
+    start = time.perf_counter()
+    _, indices = search()
+    return indices, (time.perf_counter() - start) * 1000 / num_queries
+
+
+def main(args):
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+    vectors = load_vectors(args)
+    if args.normalize:
+        vectors = vectors / vectors.norm(dim=-1, keepdim=True)
+    gallery, queries = vectors[:-args.queries], vectors[-args.queries:]
+    num_items, dim = gallery.shape
+    search_args = dict(chunk_size=args.chunk_size, num_workers=args.search_workers)
+
+    exact, elapsed = timed_search(lambda: streaming_top_k(queries, gallery, args.k, **search_args), args.queries)
+    print('%d gallery vectors, %d-d, %d queries, recall@%d of exact top-%d' % (num_items, dim, args.queries,
+                                                                             args.k, args.k))
+    print('%-10s %9s %10s %7s %8s %12s %8s  %s' % ('method', 'bytes/vec', 'memory MB', 'ratio', 'train s',
+                                                   'ms/query', 'codes', '  '.join('rescore@%d' % s
+                                                                                  for s in args.shortlists)))
+    print('%-10s %9d %10.1f %7.1f %8s %12.2f %8.4f' % ('float32', dim * 4, num_items * dim * 4 / 2 ** 20, 1.,
+                                                       '-', elapsed, 1.))
+
+    quantizers = [('int8', ScalarQuantizer())]
+    quantizers += [('pq%d' % m, ProductQuantizer(m, iters=args.iters, seed=args.seed))
+                   for m in args.subvectors if dim % m == 0]
+    sample = train_sample(gallery, args.num_train, args.seed)
+    for name, quantizer in quantizers:
+        start = time.perf_counter()
+        quantizer.train(sample)
+        codes = compress(quantizer, gallery)
+        train_time = time.perf_counter() - start
+
+        memory = codes.numel() + quantizer.codebook_bytes()
+        indices, elapsed = timed_search(lambda: compressed_search(quantizer, codes, queries, args.k, **search_args),
+                                        args.queries)
+        rescored = []
+        for shortlist in args.shortlists:
+            indices_rescored, elapsed_rescored = timed_search(
+                lambda: compressed_search(quantizer, codes, queries, args.k, vectors=gallery, shortlist=shortlist,
+                                          **search_args), args.queries)
+            rescored.append('%9.4f' % recall(indices_rescored, exact))
+        print('%-10s %9d %10.1f %7.1f %8.1f %5.2f/%6.2f %8.4f  %s' % (
+            name, quantizer.code_size(), memory / 2 ** 20, num_items * dim * 4 / memory, train_time, elapsed,
+            elapsed_rescored, recall(indices, exact), '  '.join(rescored)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vectors', default=[], nargs='+')
+    parser.add_argument('--shards', default='')
+    parser.add_argument('--field', default='image_feats')
+    parser.add_argument('--synthetic', default=100000, type=int)
+    parser.add_argument('--dim', default=768, type=int)
+    parser.add_argument('--normalize', action='store_true')
+    parser.add_argument('--queries', default=1000, type=int)
+    parser.add_argument('--k', default=10, type=int)
+    parser.add_argument('--subvectors', default=[16, 32, 64, 96], type=int, nargs='+')
+    parser.add_argument('--shortlists', default=[10, 50, 200], type=int, nargs='+')
+    parser.add_argument('--num_train', default=50000, type=int)
+    parser.add_argument('--iters', default=20, type=int)
+    parser.add_argument('--chunk_size', default=16384, type=int)
+    parser.add_argument('--search_workers', default=0, type=int)
+    parser.add_argument('--seed', default=42, type=int)
+    parser.add_argument('--threads', default=0, type=int)
+    args = parser.parse_args()
+    main(args)
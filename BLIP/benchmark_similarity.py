@@ -0,0 +1,90 @@
+'''
+Time and memory of ITC retrieval evaluation with the full similarity matrix and with streaming_top_k
+(retrieval/similarity.py).
+
+The full version builds the [queries, gallery] matrix and argsorts every row, as the retrieval evaluation of
+coco_karpathy_retrieval_eval / flickr30k_retrieval_eval does; the streamed one keeps the top --k per query. Both
+run on random normalized features, each in its own process, and the script reports time, the peak memory added
+and whether the top-k lists agree. A run that gets killed, usually the full matrix running out of memory, is
+reported as failed. COCO test is 25k texts x 5k images.
+
+    python benchmark_similarity.py --queries 25000 --gallery 5000 100000 --num_workers 0 4
+'''
+import argparse
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import torch
+
+from retrieval.similarity import streaming_top_k
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def features(args, num_items, seed):
+    # normalized in place, so that building them does not raise the peak memory
+    feats = torch.randn(num_items, args.embed_dim, generator=torch.Generator().manual_seed(seed))
+    return feats.div_(feats.norm(dim=-1, keepdim=True))
+
+
+def run(args, gallery_size, num_workers):
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+    query_feats, gallery_feats = features(args, args.queries, args.seed), features(args, gallery_size, args.seed + 1)
+    base = peak_rss()
+    start = time.perf_counter()
+    if num_workers is None:
+        indices = (query_feats @ gallery_feats.t()).argsort(dim=1, descending=True)[:, :args.k]
+    else:
+        _, indices = streaming_top_k(query_feats, gallery_feats, args.k, chunk_size=args.chunk_size,
+                                     query_chunk_size=args.query_chunk_size, num_workers=num_workers,
+                                     backend=args.backend)
+    return time.perf_counter() - start, peak_rss() - base, indices
+
+
+def measure(args, gallery_size, num_workers):
+    try:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            return executor.submit(run, args, gallery_size, num_workers).result()
+    except BrokenProcessPool:
+        return None
+
+
+def main(args):
+    print('%d queries, %d-d, top %d, %d threads' % (args.queries, args.embed_dim, args.k,
+                                                    args.threads or torch.get_num_threads()))
+    for gallery_size in args.gallery:
+        full = measure(args, gallery_size, None)
+        if full is None:
+            print('gallery %7d  full matrix + argsort  failed' % gallery_size)
+        else:
+            print('gallery %7d  full matrix + argsort  %8.2f s  +%8.1f MB' % (gallery_size, full[0], full[1]))
+        for num_workers in args.num_workers:
+            streamed = measure(args, gallery_size, num_workers)
+            if streamed is None:
+                print('gallery %7d  streamed, %d %s workers  failed' % (gallery_size, num_workers, args.backend))
+                continue
+            agree = (streamed[2] == full[2]).float().mean().item() if full is not None else float('nan')
+            print('gallery %7d  streamed, %d %s workers  %8.2f s  +%8.1f MB  same top-k %.4f' % (
+                gallery_size, num_workers, args.backend, streamed[0], streamed[1], agree))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queries', default=25000, type=int)
+    parser.add_argument('--gallery', default=[5000, 100000], type=int, nargs='+')
+    parser.add_argument('--embed_dim', default=256, type=int)
+    parser.add_argument('--k', default=10, type=int)
+    parser.add_argument('--chunk_size', default=16384, type=int)
+    parser.add_argument('--query_chunk_size', default=1024, type=int)
+    parser.add_argument('--num_workers', default=[0], type=int, nargs='+')
+    parser.add_argument('--backend', default='thread', choices=['thread', 'process'])
+    parser.add_argument('--seed', default=42, type=int)
+    parser.add_argument('--threads', default=0, type=int)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,141 @@
+'''
+Accuracy/speed trade-off of ViT token merging (VisionTransformer token_merge_ratio) on a small fixture set.
+
+For each ratio, the captioner and the ITM model encode the images in --image_dir with merging enabled and the
+script reports the number of image tokens left for cross-attention, the ViT and caption decoding time, how
+many captions are unchanged from the first ratio (normally 0) and their word F1 against the reference
+captions, and image-to-text ITM retrieval accuracy over the fixture set along with the mean change of the ITM
+match probability.
+
+Reference captions come from --captions, a JSON file mapping image file names to captions; without it the
+captions of the first ratio are used.
+
+    python benchmark_token_merging.py --caption_model model_base_caption_capfilt_large.pth \
+        --itm_model model_base_retrieval_coco.pth --image_dir fixtures/images --ratios 0 0.03 0.05 0.1
+'''
+import argparse
+import glob
+import json
+import os
+import time
+
+import torch
+from PIL import Image
+from torchvision import transforms
+from torchvision.transforms.functional import InterpolationMode
+
+from models.blip import blip_decoder
+from models.blip_itm import blip_itm
+
+
+def load_images(image_dir, image_size):
+    transform = transforms.Compose([
+        transforms.Resize((image_size, image_size), interpolation=InterpolationMode.BICUBIC),
+        transforms.ToTensor(),
+        transforms.Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711)),
+    ])
+    paths = sorted(p for ext in ('jpg', 'jpeg', 'png') for p in glob.glob(os.path.join(image_dir, '*.' + ext)))
+    assert paths, 'no images found in %s' % image_dir
+    return [os.path.basename(p) for p in paths], torch.stack([transform(Image.open(p).convert('RGB')) for p in paths])
+
+
+def word_f1(caption, reference):
+    words, ref_words = caption.split(), reference.split()
+    common = sum(min(words.count(w), ref_words.count(w)) for w in set(words))
+    if common == 0:
+        return 0.
+    precision, recall = common / len(words), common / len(ref_words)
+    return 2 * precision * recall / (precision + recall)
+
+
+def caption(model, images, args):
+    vit_time = decode_time = 0.
+    captions = []
+    for i in range(0, images.size(0), args.batch_size):
+        batch = images[i:i + args.batch_size]
+        start = time.perf_counter()
+        image_embeds, image_atts = model.visual_encoder(batch, return_atts=True)
+        encoded = time.perf_counter()
+        captions += model.generate(batch, num_beams=args.num_beams, max_length=args.max_length,
+                                   min_length=args.min_length)
+        done = time.perf_counter()
+        vit_time += encoded - start
+        # generate() encodes the images again, only its decoding part is counted
+        decode_time += (done - encoded) - (encoded - start)
+    return captions, image_embeds.size(1), vit_time, decode_time
+
+
+def itm_scores(model, images, captions, device):
+    # [images, captions] ITM match probabilities
+    image_embeds, image_atts = model.visual_encoder(images, return_atts=True)
+    scores = []
+    for text in captions:
+        text = model.tokenizer([text] * images.size(0), padding='max_length', truncation=True, max_length=35,
+                               return_tensors="pt").to(device)
+        output = model.text_encoder(text.input_ids,
+                                    attention_mask = text.attention_mask,
+                                    encoder_hidden_states = image_embeds,
+                                    encoder_attention_mask = image_atts,
+                                    return_dict = True,
+                                   )
+        scores.append(model.itm_head(output.last_hidden_state[:, 0, :]).softmax(dim=-1)[:, 1])
+    return torch.stack(scores, dim=1)
+
+
+@torch.no_grad()
+def main(args):
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+    device = torch.device(args.device)
+    names, images = load_images(args.image_dir, args.image_size)
+    images = images.to(device)
+    captioner = blip_decoder(pretrained=args.caption_model, image_size=args.image_size, vit=args.vit).to(device).eval()
+    matcher = blip_itm(pretrained=args.itm_model, image_size=args.image_size, vit=args.vit).to(device).eval()
+
+    references = None
+    if args.captions:
+        with open(args.captions) as f:
+            annotations = json.load(f)
+        references = [annotations[name] for name in names]
+
+    print('%d images at %d px, ViT-%s, %s' % (len(names), args.image_size, args.vit, device))
+    print('ratio  tokens  ViT ms/img  decode ms/img  same caption  word F1  ITM R@1  ITM |delta|')
+    base_captions = base_scores = None
+    for ratio in args.ratios:
+        captioner.visual_encoder.token_merge_ratio = ratio
+        matcher.visual_encoder.token_merge_ratio = ratio
+        captions, tokens, vit_time, decode_time = caption(captioner, images, args)
+        if base_captions is None:
+            base_captions = captions
+            references = references or captions
+        scores = itm_scores(matcher, images, references, device)
+        if base_scores is None:
+            base_scores = scores
+
+        same = sum(a == b for a, b in zip(base_captions, captions)) / len(names)
+        f1 = sum(word_f1(c, r) for c, r in zip(captions, references)) / len(names)
+        recall = (scores.argmax(dim=1) == torch.arange(len(names), device=device)).float().mean().item()
+        delta = (scores - base_scores).abs().mean().item()
+        print('%5.2f  %6d  %10.1f  %13.1f  %12.3f  %7.3f  %7.3f  %11.4f' % (
+            ratio, tokens, vit_time * 1000 / len(names), decode_time * 1000 / len(names), same, f1, recall, delta))
+        for name, base, merged in zip(names, base_captions, captions):
+            if ratio and base != merged:
+                print('    %s: %s -> %s' % (name, base, merged))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--caption_model', default='')
+    parser.add_argument('--itm_model', default='')
+    parser.add_argument('--vit', default='base')
+    parser.add_argument('--image_size', default=384, type=int)
+    parser.add_argument('--image_dir', required=True)
+    parser.add_argument('--captions', default='')
+    parser.add_argument('--ratios', default=[0., 0.03, 0.05, 0.1], type=float, nargs='+')
+    parser.add_argument('--batch_size', default=8, type=int)
+    parser.add_argument('--num_beams', default=3, type=int)
+    parser.add_argument('--max_length', default=30, type=int)
+    parser.add_argument('--min_length', default=10, type=int)
+    parser.add_argument('--threads', default=0, type=int)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,84 @@
+'''
+CPU speed and memory of the fused ViT attention in models/vit.py.
+
+Runs the ViT image encoder with the explicit softmax(q @ k^T) @ v attention and with the
+scaled_dot_product_attention path, at each of the given image sizes, on random weights. It reports time per batch,
+the peak memory the forward pass adds on top of the model and the largest output difference. Each run happens in
+its own process.
+
+    python benchmark_vit_attention.py --vit base --image_sizes 224 384 480 --batch_size 8 --threads 8
+'''
+import argparse
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+from models.blip import create_vit
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(args, image_size, fused):
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+    torch.manual_seed(args.seed)
+    visual_encoder, _ = create_vit(args.vit, image_size)
+    visual_encoder.train(args.backward)
+    for module in visual_encoder.modules():
+        if hasattr(module, 'fused_attn'):
+            module.fused_attn = fused
+    images = torch.randn(args.batch_size, 3, image_size, image_size, generator=torch.Generator().manual_seed(args.seed))
+
+    def forward():
+        image_embeds = visual_encoder(images)
+        if args.backward:
+            image_embeds.mean().backward()
+            visual_encoder.zero_grad(set_to_none=True)
+        return image_embeds.detach()
+
+    base = peak_rss()
+    with torch.set_grad_enabled(args.backward):
+        output = forward()
+        memory = peak_rss() - base
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            forward()
+        elapsed = (time.perf_counter() - start) / args.repeats
+    return elapsed, memory, output[:2].clone()
+
+
+def measure(args, image_size, fused):
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(run, args, image_size, fused).result()
+
+
+def main(args):
+    print('ViT-%s, batch %d, %s, %d threads' % (args.vit, args.batch_size,
+                                               'forward+backward' if args.backward else 'forward',
+                                               args.threads or torch.get_num_threads()))
+    for image_size in args.image_sizes:
+        eager = measure(args, image_size, False)
+        fused = measure(args, image_size, True)
+        tokens = (image_size // 16) ** 2 + 1
+        print('%d px (%d tokens)  explicit %8.1f ms +%7.1f MB   fused %8.1f ms +%7.1f MB   '
+              'speedup %.2fx   max abs difference %.2e' % (
+                  image_size, tokens, eager[0] * 1000, eager[1], fused[0] * 1000, fused[1],
+                  eager[0] / fused[0], (eager[2] - fused[2]).abs().max().item()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vit', default='base', choices=['base', 'large'])
+    parser.add_argument('--image_sizes', default=[224, 384, 480], type=int, nargs='+')
+    parser.add_argument('--batch_size', default=8, type=int)
+    parser.add_argument('--backward', action='store_true')
+    parser.add_argument('--repeats', default=3, type=int)
+    parser.add_argument('--seed', default=42, type=int)
+    parser.add_argument('--threads', default=0, type=int)
+    args = parser.parse_args()
+    main(args)
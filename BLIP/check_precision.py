@@ -0,0 +1,169 @@
+'''
+Accuracy and speed check of a reduced-precision serving profile against fp32.
+
+Runs the captioner over the images in --image_dir and BGE over a fixed set of sentences with both
+fp32 and the chosen profile, then reports caption agreement, embedding cosine similarity,
+throughput, weight memory and the resident memory of a fresh process serving with each profile.
+Exits non-zero when the profile falls below the given thresholds.
+
+    python check_precision.py --profile int8 --image_dir fixtures/images
+'''
+import argparse
+import copy
+import glob
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from transformers import BlipProcessor, BlipForConditionalGeneration
+from FlagEmbedding import FlagModel
+
+from serving.pipeline import analyze_images, encode_texts
+from serving.precision import PROFILES, apply_profile, compute_dtype, model_bytes
+from serving.weights import load_mmap
+
+EMBED_PROMPT = "Represent this sentence for semantic search:"
+FIXTURE_TEXTS = [
+    "quarterly disk usage report for the build servers",
+    "non-disclosure agreement between the company and a supplier",
+    "a dog running on the beach",
+    "how do I reset my LDAP password",
+    "screenshot of an error dialog in the drive upload page",
+    "temperature sensor readings above the alert threshold",
+    "meeting notes from the security review",
+    "a red car parked in front of an office building",
+    "invoice",
+    "failed ssh login attempts from an unknown address over the weekend, "
+    "grouped by user and source host, with the commands run after each successful login",
+]
+
+
+def load_images(image_dir):
+    paths = sorted(p for ext in ('jpg', 'jpeg', 'png', 'webp') for p in glob.glob(os.path.join(image_dir, '*.' + ext)))
+    assert paths, 'no images found in %s' % image_dir
+    return [Image.open(p).convert('RGB') for p in paths]
+
+
+def timed(fn, repeats):
+    fn()  # warmup
+    start = time.perf_counter()
+    for _ in range(repeats):
+        out = fn()
+    return out, (time.perf_counter() - start) / repeats
+
+
+def run_captioner(model, processor, images, dtype, batch_size):
+    captions, embeddings = [], []
+    for i in range(0, len(images), batch_size):
+        c, e = analyze_images(model, processor, images[i:i + batch_size], dtype=dtype)
+        captions += c
+        embeddings.append(e)
+    return captions, torch.cat(embeddings)
+
+
+def load_models(args):
+    if args.weights_dir:
+        processor = BlipProcessor.from_pretrained(os.path.join(args.weights_dir, 'blip'))
+        blip = load_mmap(BlipForConditionalGeneration, os.path.join(args.weights_dir, 'blip'))
+        bge = FlagModel(os.path.join(args.weights_dir, 'bge'))
+    else:
+        processor = BlipProcessor.from_pretrained(args.blip_model)
+        blip = BlipForConditionalGeneration.from_pretrained(args.blip_model)
+        bge = FlagModel(args.bge_model)
+    blip.eval()
+    bge.model.eval()
+    return processor, blip, bge
+
+
+def resident_mb():
+    # current resident set size (Linux); unlike ru_maxrss it drops again once fp32 weights are converted
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+
+
+def serving_rss(args, profile):
+    # resident memory of a process holding only this profile's models, after serving the fixtures once
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+    processor, blip, bge = load_models(args)
+    blip = apply_profile(blip, profile)
+    bge.model = apply_profile(bge.model, profile)
+    run_captioner(blip, processor, load_images(args.image_dir), compute_dtype(profile), args.batch_size)
+    encode_texts(bge.model, bge.tokenizer, ['%s %s' % (EMBED_PROMPT, text) for text in FIXTURE_TEXTS],
+                 args.max_batch_tokens)
+    return resident_mb()
+
+
+def measure_rss(args, profile):
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(serving_rss, args, profile).result()
+
+
+def main(args):
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+    images = load_images(args.image_dir)
+    processor, blip, bge = load_models(args)
+
+    blip_profile = apply_profile(copy.deepcopy(blip), args.profile)
+    bge_profile = apply_profile(copy.deepcopy(bge.model), args.profile)
+    dtype = compute_dtype(args.profile)
+    texts = ['%s %s' % (EMBED_PROMPT, text) for text in FIXTURE_TEXTS]
+
+    (ref_captions, ref_image_embeds), ref_caption_time = timed(
+        lambda: run_captioner(blip, processor, images, torch.float32, args.batch_size), args.repeats)
+    (captions, image_embeds), caption_time = timed(
+        lambda: run_captioner(blip_profile, processor, images, dtype, args.batch_size), args.repeats)
+
+    ref_text_embeds, ref_embed_time = timed(
+        lambda: encode_texts(bge.model, bge.tokenizer, texts, args.max_batch_tokens), args.repeats)
+    text_embeds, embed_time = timed(
+        lambda: encode_texts(bge_profile, bge.tokenizer, texts, args.max_batch_tokens), args.repeats)
+
+    caption_match = sum(a == b for a, b in zip(ref_captions, captions)) / len(images)
+    image_cos = F.cosine_similarity(ref_image_embeds, image_embeds, dim=-1)
+    text_cos = F.cosine_similarity(ref_text_embeds, text_embeds, dim=-1)
+
+    print('profile %s vs fp32 on %d images, %d texts' % (args.profile, len(images), len(texts)))
+    print('caption exact match:    %.3f' % caption_match)
+    print('image embedding cosine: mean %.4f  min %.4f' % (image_cos.mean(), image_cos.min()))
+    print('text embedding cosine:  mean %.4f  min %.4f' % (text_cos.mean(), text_cos.min()))
+    print('captioner throughput:   %.2f -> %.2f images/s (%.2fx)' % (
+        len(images) / ref_caption_time, len(images) / caption_time, ref_caption_time / caption_time))
+    print('embedder throughput:    %.2f -> %.2f texts/s (%.2fx)' % (
+        len(texts) / ref_embed_time, len(texts) / embed_time, ref_embed_time / embed_time))
+    print('weights:                BLIP %.0f -> %.0f MB, BGE %.0f -> %.0f MB' % (
+        model_bytes(blip) / 2**20, model_bytes(blip_profile) / 2**20,
+        model_bytes(bge.model) / 2**20, model_bytes(bge_profile) / 2**20))
+    ref_rss, rss = measure_rss(args, 'fp32'), measure_rss(args, args.profile)
+    print('resident memory:        %.0f -> %.0f MB (%.2fx)' % (ref_rss, rss, ref_rss / rss))
+    for ref, caption in zip(ref_captions, captions):
+        if ref != caption:
+            print('  fp32: %s\n  %s: %s' % (ref, args.profile, caption))
+
+    passed = (caption_match >= args.min_caption_match and image_cos.min() >= args.min_cosine
+              and text_cos.min() >= args.min_cosine)
+    print('PASS' if passed else 'FAIL')
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profile', default='bf16', choices=[p for p in PROFILES if p != 'fp32'])
+    parser.add_argument('--image_dir', required=True)
+    parser.add_argument('--weights_dir', default='')
+    parser.add_argument('--blip_model', default='Salesforce/blip-image-captioning-base')
+    parser.add_argument('--bge_model', default='BAAI/bge-base-en')
+    parser.add_argument('--batch_size', default=8, type=int)
+    parser.add_argument('--max_batch_tokens', default=16384, type=int)
+    parser.add_argument('--repeats', default=3, type=int)
+    parser.add_argument('--threads', default=0, type=int)
+    parser.add_argument('--min_caption_match', default=0.7, type=float)
+    parser.add_argument('--min_cosine', default=0.98, type=float)
+    args = parser.parse_args()
+    sys.exit(main(args))
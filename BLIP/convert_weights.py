@@ -0,0 +1,36 @@
+'''
+Pre-converts the models served by hehe.py into a local directory that starts fast:
+the BLIP captioner as an mmap-able torch file (see serving/weights.py) plus its processor,
+and BGE as a local HuggingFace checkpoint. Point BLIP_WEIGHTS_DIR at the output directory.
+'''
+import argparse
+import os
+
+from transformers import BlipProcessor, BlipForConditionalGeneration
+from FlagEmbedding import FlagModel
+
+from serving.weights import save_mmap
+
+
+def main(args):
+    blip_dir = os.path.join(args.output_dir, 'blip')
+    processor = BlipProcessor.from_pretrained(args.blip_model)
+    model = BlipForConditionalGeneration.from_pretrained(args.blip_model)
+    save_mmap(model, blip_dir)
+    processor.save_pretrained(blip_dir)
+    print('saved %s to %s' % (args.blip_model, blip_dir))
+
+    bge_dir = os.path.join(args.output_dir, 'bge')
+    bge = FlagModel(args.bge_model)
+    bge.model.save_pretrained(bge_dir, safe_serialization=True)
+    bge.tokenizer.save_pretrained(bge_dir)
+    print('saved %s to %s' % (args.bge_model, bge_dir))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_dir', default='weights')
+    parser.add_argument('--blip_model', default='Salesforce/blip-image-captioning-base')
+    parser.add_argument('--bge_model', default='BAAI/bge-base-en')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,146 @@
+'''
+Recall@1/5/10 and per-stage latency of the two-stage retrieval engine (retrieval/engine.py) on the Karpathy COCO
+or Flickr30k retrieval splits.
+
+The split's images and captions are indexed as the gallery, then every caption queries the images (text->image)
+and every image queries the captions (image->text): ITC top-k_test first, ITM reranking of those second. Recall is
+reported for stage one alone and after reranking. Stage one streams over the gallery in --chunk_size chunks on
+--search_workers threads and never builds the full similarity matrix. With --stage_one_gallery N the script also
+times stage one on a random gallery of N normalized features.
+
+With --shards the gallery is not encoded but memory-mapped from the output of extract_features.py for the same
+split; reranking then needs it to have been extracted with --image_embeds.
+
+    python evaluate_retrieval.py --config configs/retrieval_coco.yaml --split test --stage_one_gallery 100000
+    python evaluate_retrieval.py --config configs/retrieval_coco.yaml --split test --shards features/coco_test
+'''
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+import yaml
+from torch.utils.data import DataLoader
+
+from data import create_dataset
+from models.blip_retrieval import blip_retrieval
+from retrieval.engine import RetrievalEngine
+from retrieval.evaluation import recall_at_k, itc_eval, dataset_ground_truth
+
+
+def build_gallery(engine, dataset, args):
+    start = time.perf_counter()
+    loader = DataLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers, shuffle=False)
+    for images, _ in loader:
+        engine.add_images(images, keep_embeds=not args.no_rerank)
+    image_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(0, len(dataset.text), args.batch_size):
+        engine.add_texts(dataset.text[i:i + args.batch_size])
+    text_time = time.perf_counter() - start
+    return image_time / len(dataset.image), text_time / len(dataset.text)
+
+
+def run_queries(rank, num_queries, rerank, args):
+    # ranked ids per query and the summed stage timings
+    timings = {}
+    ranked = []
+    for i in range(0, num_queries, args.query_batch_size):
+        batch = slice(i, min(i + args.query_batch_size, num_queries))
+        ranked.append(rank(batch, rerank, timings)[0].cpu())
+    return torch.cat(ranked), timings
+
+
+def stage_one_latency(engine, num_items, embed_dim, device, repeats=20):
+    gallery = F.normalize(torch.randn(num_items, embed_dim, device=device), dim=-1)
+    query = F.normalize(torch.randn(1, embed_dim, device=device), dim=-1)
+    engine.top_k(query, gallery, engine.k_test)  # warmup
+    start = time.perf_counter()
+    for _ in range(repeats):
+        engine.top_k(query, gallery, engine.k_test)
+    return (time.perf_counter() - start) / repeats
+
+
+def report(name, ranked, ground_truth, timings, num_queries):
+    recall = recall_at_k(ranked, ground_truth)
+    print('%s  %s  R@1 %.2f  R@5 %.2f  R@10 %.2f' % (name, 'ITM' if 'itm' in timings else 'ITC',
+                                                    recall[1], recall[5], recall[10]))
+    print('%s  latency per query: %s' % (name, '  '.join(
+        '%s %.2f ms' % (stage, seconds * 1000 / num_queries) for stage, seconds in timings.items())))
+
+
+@torch.no_grad()
+def main(args):
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+    device = torch.device(args.device)
+
+    _, val_dataset, test_dataset = create_dataset('retrieval_%s' % config['dataset'], config)
+    dataset = val_dataset if args.split == 'val' else test_dataset
+    model = blip_retrieval(pretrained=args.pretrained or config['pretrained'], image_size=config['image_size'],
+                           vit=config['vit'], queue_size=config['queue_size'])
+    model = model.to(device).eval()
+    engine = RetrievalEngine(model, k_test=args.k_test or config['k_test'], itm_batch_size=args.itm_batch_size,
+                             chunk_size=args.chunk_size, num_workers=args.search_workers)
+
+    if args.shards:
+        image_ids, text_ids = engine.load_shards(args.shards)
+        assert image_ids == dataset.image and text_ids == list(range(len(dataset.text))), \
+            '%s was not extracted from the %s split, or not completely' % (args.shards, args.split)
+        print('%s %s: %d images, %d texts memory-mapped from %s, k_test %d' % (
+            config['dataset'], args.split, len(image_ids), len(text_ids), args.shards, engine.k_test))
+    else:
+        image_time, text_time = build_gallery(engine, dataset, args)
+        print('%s %s: %d images (%.1f ms each), %d texts (%.1f ms each), k_test %d' % (
+            config['dataset'], args.split, len(dataset.image), image_time * 1000, len(dataset.text),
+            text_time * 1000, engine.k_test))
+
+    result = itc_eval(engine.image_feats, engine.text_feats, dataset.txt2img, dataset.img2txt,
+                      chunk_size=args.chunk_size, num_workers=args.search_workers)
+    print('ITC over the full split: ' + '  '.join('%s %.2f' % item for item in result.items()))
+
+    text_to_image, image_to_text = dataset_ground_truth(dataset)
+    num_texts = min(len(dataset.text), args.max_queries or len(dataset.text))
+    num_images = min(len(dataset.image), args.max_queries or len(dataset.image))
+
+    def rank_images(batch, rerank, timings):
+        return engine.rank_images(engine.text_feats[batch], engine.text_ids[batch], engine.text_atts[batch],
+                                  k=10, rerank=rerank, timings=timings)
+
+    def rank_texts(batch, rerank, timings):
+        image_embeds = engine.image_embeds[batch] if engine.image_embeds is not None else None
+        return engine.rank_texts(engine.image_feats[batch], image_embeds, k=10, rerank=rerank, timings=timings)
+
+    for rerank in [False] if args.no_rerank else [False, True]:
+        ranked, timings = run_queries(rank_images, num_texts, rerank, args)
+        report('text->image', ranked, text_to_image[:num_texts], timings, num_texts)
+        ranked, timings = run_queries(rank_texts, num_images, rerank, args)
+        report('image->text', ranked, image_to_text[:num_images], timings, num_images)
+
+    if args.stage_one_gallery:
+        latency = stage_one_latency(engine, args.stage_one_gallery, engine.image_feats.shape[1], device)
+        print('stage one, %d-item gallery: %.2f ms per query' % (args.stage_one_gallery, latency * 1000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='configs/retrieval_coco.yaml')
+    parser.add_argument('--split', default='test', choices=['val', 'test'])
+    parser.add_argument('--pretrained', default='')
+    parser.add_argument('--shards', default='')
+    parser.add_argument('--k_test', default=0, type=int)
+    parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--query_batch_size', default=64, type=int)
+    parser.add_argument('--itm_batch_size', default=128, type=int)
+    parser.add_argument('--max_queries', default=0, type=int)
+    parser.add_argument('--no_rerank', action='store_true')
+    parser.add_argument('--stage_one_gallery', default=0, type=int)
+    parser.add_argument('--chunk_size', default=16384, type=int)
+    parser.add_argument('--search_workers', default=0, type=int)
+    parser.add_argument('--num_workers', default=4, type=int)
+    parser.add_argument('--threads', default=0, type=int)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    main(args)
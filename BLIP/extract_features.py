@@ -0,0 +1,101 @@
+'''
+Resumable offline extraction of BLIP_Retrieval features for a Karpathy COCO or Flickr30k retrieval split.
+
+Images and captions are streamed through the ViT and the text encoder in --batch_size batches, and the results
+are appended to fixed-size .npy shards (retrieval/shards.py) under --output_dir:
+
+    images/  image_feats [256] float32, and image_embeds [tokens, 768] float16 with --image_embeds
+    texts/   text_feats [256] float32, text_ids and text_atts [35] int64 (the ITM input)
+
+Each directory has a manifest.json, updated after every batch. Rerunning the command after an interruption
+skips the images (by file name) and captions (by index) already extracted. evaluate_retrieval.py --shards and
+RetrievalEngine.load_shards() open the result memory-mapped.
+
+    python extract_features.py --config configs/retrieval_coco.yaml --split test --output_dir features/coco_test \
+        --image_embeds
+'''
+import argparse
+import os
+import time
+
+import torch
+import yaml
+from torch.utils.data import DataLoader, Subset
+
+from data import create_dataset
+from models.blip_retrieval import blip_retrieval
+from retrieval.engine import RetrievalEngine
+from retrieval.shards import ShardWriter
+
+
+def extract_images(engine, dataset, args):
+    embed_dim = engine.model.vision_proj.out_features
+    fields = {'image_feats': ((embed_dim,), 'float32')}
+    if args.image_embeds:
+        tokens = engine.model.visual_encoder.patch_embed.num_patches + 1
+        fields['image_embeds'] = ((tokens, engine.model.visual_encoder.embed_dim), 'float16')
+    writer = ShardWriter(os.path.join(args.output_dir, 'images'), fields, args.shard_size)
+
+    done = set(writer.ids)
+    todo = [i for i, name in enumerate(dataset.image) if name not in done]
+    loader = DataLoader(Subset(dataset, todo), batch_size=args.batch_size, num_workers=args.num_workers,
+                        shuffle=False)
+    start = time.perf_counter()
+    for images, index in loader:
+        image_feats, image_embeds = engine.encode_images(images)
+        arrays = {'image_feats': image_feats}
+        if args.image_embeds:
+            arrays['image_embeds'] = image_embeds.half()
+        writer.write([dataset.image[i] for i in index.tolist()], **arrays)
+    return len(done), len(todo), time.perf_counter() - start
+
+
+def extract_texts(engine, dataset, args):
+    fields = {'text_feats': ((engine.model.text_proj.out_features,), 'float32'),
+              'text_ids': ((engine.max_length,), 'int64'),
+              'text_atts': ((engine.max_length,), 'int64')}
+    writer = ShardWriter(os.path.join(args.output_dir, 'texts'), fields, args.shard_size)
+
+    done = set(writer.ids)
+    todo = [i for i in range(len(dataset.text)) if i not in done]
+    start = time.perf_counter()
+    for i in range(0, len(todo), args.batch_size):
+        index = todo[i:i + args.batch_size]
+        text_feats, text_ids, text_atts = engine.encode_texts([dataset.text[j] for j in index])
+        writer.write(index, text_feats=text_feats, text_ids=text_ids, text_atts=text_atts)
+    return len(done), len(todo), time.perf_counter() - start
+
+
+@torch.no_grad()
+def main(args):
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+    device = torch.device(args.device)
+
+    _, val_dataset, test_dataset = create_dataset('retrieval_%s' % config['dataset'], config)
+    dataset = val_dataset if args.split == 'val' else test_dataset
+    model = blip_retrieval(pretrained=args.pretrained or config['pretrained'], image_size=config['image_size'],
+                           vit=config['vit'], queue_size=config['queue_size'])
+    engine = RetrievalEngine(model.to(device).eval())
+
+    for name, extract in [('images', extract_images), ('texts', extract_texts)]:
+        skipped, extracted, elapsed = extract(engine, dataset, args)
+        print('%s: %d already extracted, %d extracted in %.1f s (%.1f ms each)' % (
+            name, skipped, extracted, elapsed, elapsed * 1000 / max(extracted, 1)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='configs/retrieval_coco.yaml')
+    parser.add_argument('--split', default='test', choices=['val', 'test'])
+    parser.add_argument('--pretrained', default='')
+    parser.add_argument('--output_dir', required=True)
+    parser.add_argument('--image_embeds', action='store_true')
+    parser.add_argument('--shard_size', default=4096, type=int)
+    parser.add_argument('--batch_size', default=128, type=int)
+    parser.add_argument('--num_workers', default=4, type=int)
+    parser.add_argument('--threads', default=0, type=int)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    main(args)
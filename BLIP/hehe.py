@@ -1,51 +1,349 @@
-from flask import Flask, request, jsonify
+import time
+START_TIME = time.perf_counter()
+
+from flask import Flask, Response, request, jsonify
+from werkzeug.exceptions import HTTPException
 from PIL import Image
 import torch
 from transformers import BlipProcessor, BlipForConditionalGeneration
-import io
+import os
+import sys
+import threading
 from FlagEmbedding import FlagModel
-import torch.nn.functional as F
+
+from serving.batcher import MicroBatcher, QueueFull, RequestTimeout
+from serving.workers import WorkerPool, ItemError, WorkerDied, share_weights
+from serving.cache import ResultCache, content_key, normalize_text
+from serving import codec
+from serving.weights import load_mmap
+from serving.pipeline import analyze_images, encode_texts
+from serving.images import ImagePreprocessor, decode_image as decode_upload
+from serving.precision import PROFILES, apply_profile, compute_dtype
+from serving import metrics
 app = Flask(__name__)
 
+# micro-batching of /analyze: up to MAX_BATCH_SIZE images, first image waits at most MAX_WAIT_MS
+MAX_BATCH_SIZE = int(os.environ.get("BLIP_MAX_BATCH_SIZE", 8))
+MAX_WAIT_MS = float(os.environ.get("BLIP_MAX_WAIT_MS", 10))
+MAX_QUEUE_SIZE = int(os.environ.get("BLIP_MAX_QUEUE_SIZE", 256))
+REQUEST_TIMEOUT = float(os.environ.get("BLIP_REQUEST_TIMEOUT", 60))
+# with more than one worker, /analyze runs in forked processes that share the weights loaded below
+NUM_WORKERS = int(os.environ.get("BLIP_NUM_WORKERS", 1))
+
+# /embed: texts are length-sorted and encoded in batches of at most EMBED_MAX_BATCH_TOKENS padded tokens
+# and EMBED_MAX_BATCH_SIZE texts
+EMBED_MAX_TEXTS = int(os.environ.get("BLIP_EMBED_MAX_TEXTS", 1024))
+EMBED_MAX_BATCH_TOKENS = int(os.environ.get("BLIP_EMBED_MAX_BATCH_TOKENS", 16384))
+EMBED_MAX_BATCH_SIZE = int(os.environ.get("BLIP_EMBED_MAX_BATCH_SIZE", 256))
+EMBED_MAX_LENGTH = 512
+EMBED_PROMPT = "Represent this sentence for semantic search:"
+
+# content-addressed result cache: in-memory LRU, plus a directory that survives restarts if BLIP_CACHE_DIR is set
+CACHE_MAX_MB = float(os.environ.get("BLIP_CACHE_MAX_MB", 256))
+CACHE_DIR = os.environ.get("BLIP_CACHE_DIR") or None
+CACHE_DISK_MAX_MB = float(os.environ.get("BLIP_CACHE_DISK_MAX_MB", 4096))
+
+# serving profile for BLIP and BGE: fp32, bf16 or int8 (dynamic quantization of Linear layers)
+PRECISION = os.environ.get("BLIP_PRECISION", "fp32")
+if PRECISION not in PROFILES:
+    raise SystemExit(f"BLIP_PRECISION must be one of {', '.join(PROFILES)}")
+COMPUTE_DTYPE = compute_dtype(PRECISION)
+if PRECISION == "int8":
+    print("BLIP_PRECISION=int8: caption quality is unverified, run check_precision.py on the trained weights first",
+          file=sys.stderr)
+
+# startup: WEIGHTS_DIR holds the output of convert_weights.py and is loaded by mmap instead of from the hub
+WEIGHTS_DIR = os.environ.get("BLIP_WEIGHTS_DIR") or None
+LAZY_EMBED = os.environ.get("BLIP_LAZY_EMBED", "1") == "1"
+WARMUP_BATCH_SIZES = [int(b) for b in os.environ.get("BLIP_WARMUP_BATCH_SIZES", f"1,{MAX_BATCH_SIZE}").split(",") if b.strip()]
+# decode large uploads near the model's input size (JPEG DCT scaling, integer reduce for other formats)
+FAST_DECODE = os.environ.get("BLIP_FAST_DECODE", "1") == "1"
+
+# per-request stage timings: a sampled fraction is written as JSON lines to BLIP_TRACE_LOG (stderr if unset)
+TRACE_SAMPLE_RATE = float(os.environ.get("BLIP_TRACE_SAMPLE_RATE", 0))
+TRACE_LOG = os.environ.get("BLIP_TRACE_LOG") or None
+
+BLIP_MODEL = "Salesforce/blip-image-captioning-base"
+BGE_MODEL = "BAAI/bge-base-en"
+# cache namespaces: a change of model or of anything that alters outputs must change these
+ANALYZE_NAMESPACE = f"analyze:{BLIP_MODEL}:{PRECISION}:{'fast' if FAST_DECODE else 'full'}-decode:v1"
+EMBED_NAMESPACE = f"embed:{BGE_MODEL}:{EMBED_PROMPT}:{PRECISION}:v1"
+
 device = "cuda" if torch.cuda.is_available() else "cpu"
-processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
-model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base").to(device)
-model2 = FlagModel("BAAI/bge-base-en", use_fp16=torch.cuda.is_available())
+if WEIGHTS_DIR:
+    processor = BlipProcessor.from_pretrained(os.path.join(WEIGHTS_DIR, "blip"))
+    model = load_mmap(BlipForConditionalGeneration, os.path.join(WEIGHTS_DIR, "blip")).to(device)
+else:
+    processor = BlipProcessor.from_pretrained(BLIP_MODEL)
+    model = BlipForConditionalGeneration.from_pretrained(BLIP_MODEL).to(device)
 model.eval()
+model = apply_profile(model, PRECISION)
+image_preprocessor = ImagePreprocessor(processor.image_processor)
+IMAGE_SIZE = image_preprocessor.size if FAST_DECODE else None
+if NUM_WORKERS > 1 and not (WEIGHTS_DIR and PRECISION == "fp32"):
+    # fp32 weights loaded by mmap are already shared through the page cache
+    share_weights(model)
+LOAD_SECONDS = time.perf_counter() - START_TIME
+
+model2 = None
+model2_lock = threading.Lock()
+startup = {"ready": False, "load_seconds": LOAD_SECONDS, "startup_seconds": None}
+
+result_cache = ResultCache(max_bytes=int(CACHE_MAX_MB * 2**20), cache_dir=CACHE_DIR,
+                           max_disk_bytes=int(CACHE_DISK_MAX_MB * 2**20))
+
+registry = metrics.Registry()
+stage_seconds = registry.register(metrics.Histogram(
+    "blip_stage_seconds", "Time spent in each stage of a request.", ["endpoint", "stage"]))
+request_seconds = registry.register(metrics.Histogram(
+    "blip_request_seconds", "Total time to answer a request.", ["endpoint"]))
+queue_wait_seconds = registry.register(metrics.Histogram(
+    "blip_queue_wait_seconds", "Time an /analyze item waited for a batch slot.", ["endpoint"]))
+batch_size_hist = registry.register(metrics.Histogram(
+    "blip_batch_size", "Size of the batch a request was computed in.", ["endpoint"], buckets=metrics.BATCH_BUCKETS))
+requests_total = registry.register(metrics.Counter(
+    "blip_requests_total", "Requests answered, by endpoint and HTTP status.", ["endpoint", "status"]))
+trace_log = metrics.TraceLog(TRACE_SAMPLE_RATE, TRACE_LOG)
+
+
+def decode_image(image_bytes):
+    return decode_upload(image_bytes, IMAGE_SIZE)
+
+
+def analyze_batch(images):
+    timings = {}
+    captions, cls_embeddings = analyze_images(model, processor, images, dtype=COMPUTE_DTYPE, timings=timings,
+                                             image_preprocessor=image_preprocessor)
+    # rows are cloned so a cached result does not pin the whole batch tensor
+    return [{"caption": caption, "embedding": embedding.clone(), "timings": timings}
+            for caption, embedding in zip(captions, cls_embeddings)]
+
+
+def response_format():
+    # ?format= wins over the Accept header; JSON stays the default
+    fmt = request.args.get("format")
+    if fmt is None:
+        fmt = codec.MIMETYPES[request.accept_mimetypes.best_match(list(codec.MIMETYPES), default="application/json")]
+    return codec.check_format(fmt, request.args.get("dtype", "float32"))
+
+
+def embedding_response(fmt, dtype, name, embeddings, **fields):
+    if fmt == "json":
+        return jsonify(dict(fields, **{name: embeddings.tolist()}))
+    if fmt == "base64":
+        return jsonify(dict(fields, **{name: codec.pack_base64(embeddings, dtype)}))
+    body, content_type, headers = codec.encode_binary(embeddings, fmt, dtype, fields)
+    return Response(body, content_type=content_type, headers=headers)
+
+
+def traced(endpoint, handler):
+    # runs handler(trace) and records the request whatever happens: an exception that escapes it becomes Flask's
+    # error response, so it is counted with that status (500 unless it is an HTTPException)
+    trace = metrics.RequestTrace(endpoint)
+    status = 500
+    try:
+        response = handler(trace)
+        # status is taken from a (body, status) tuple or a Response
+        status = response[1] if isinstance(response, tuple) else response.status_code
+        return response
+    except HTTPException as e:
+        status = e.code
+        raise
+    finally:
+        record_trace(trace, status)
+
+
+def record_trace(trace, status):
+    # stages and fields are already on the trace
+    total = trace.elapsed()
+    for stage, seconds in trace.stages.items():
+        stage_seconds.observe(seconds, trace.endpoint, stage)
+    if "queue_wait" in trace.fields:
+        queue_wait_seconds.observe(trace.fields["queue_wait"], trace.endpoint)
+    if "batch_size" in trace.fields:
+        batch_size_hist.observe(trace.fields["batch_size"], trace.endpoint)
+    request_seconds.observe(total, trace.endpoint)
+    requests_total.inc(trace.endpoint, str(status))
+    trace_log.maybe_log(trace, status, total)
+
+
+def warmup_analyze():
+    # first calls at a new batch size pay for allocator growth and kernel selection; do that before traffic
+    blank = Image.new("RGB", (384, 384))
+    for batch_size in WARMUP_BATCH_SIZES:
+        analyze_batch([blank] * batch_size)
+
+
+if NUM_WORKERS > 1:
+    # workers receive the raw bytes and decode them themselves, so full-size pixels never cross a pipe
+    analyze_batcher = WorkerPool(analyze_batch, NUM_WORKERS, item_fn=decode_image, init_fn=warmup_analyze,
+                                 max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS, max_queue_size=MAX_QUEUE_SIZE,
+                                 timeout=REQUEST_TIMEOUT, name="analyze-worker")
+else:
+    analyze_batcher = MicroBatcher(analyze_batch, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS,
+                                   max_queue_size=MAX_QUEUE_SIZE, timeout=REQUEST_TIMEOUT, name="analyze-batcher")
+
+
 @app.route("/analyze", methods=["POST"])
 def analyze_image():
+    return traced("analyze", analyze_traced)
+
+
+def analyze_traced(trace):
+    try:
+        fmt, dtype = response_format()
+    except codec.FormatError as e:
+        return jsonify({"error": str(e)}), 400
+
     image_bytes = request.data
-    image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-    inputs = processor(image, return_tensors="pt").to(device)
-
-    # Caption
-    out = model.generate(**inputs)
-    caption = processor.decode(out[0], skip_special_tokens=True)
-
-    # Embedding
-    with torch.no_grad():
-        encoder_outputs = model.vision_model(**inputs)
-        cls_embedding = encoder_outputs.last_hidden_state[:, 0, :].squeeze().tolist()
-
-    return jsonify({
-        "caption": caption,
-        "embedding": cls_embedding
-    })
-    
+    key = content_key(ANALYZE_NAMESPACE, image_bytes)
+    result = result_cache.get(key)
+    trace.fields["cache_hit"] = result is not None
+
+    if result is None:
+        meta = {}
+        try:
+            with trace.stage("decode"):
+                item = image_bytes if NUM_WORKERS > 1 else decode_image(image_bytes)
+        except Exception:
+            return jsonify({"error": "Invalid image"}), 400
+
+        try:
+            result = analyze_batcher.submit(item, meta=meta)
+        except (QueueFull, RequestTimeout):
+            return jsonify({"error": "Server busy"}), 503
+        except WorkerDied:
+            return jsonify({"error": "Worker crashed, restarting"}), 503
+        except ItemError:
+            return jsonify({"error": "Invalid image"}), 400
+        finally:
+            # workers decode the image themselves and report how long it took
+            trace.record(decode=meta.get("item_seconds"))
+            trace.fields.update((k, meta[k]) for k in ("queue_wait", "batch_size") if k in meta)
+        # per-batch stage timings are shared by every item of the batch and are not cached
+        result = dict(result)
+        trace.record(**result.pop("timings"))
+        result_cache.put(key, result)
+
+    with trace.stage("serialize"):
+        return embedding_response(fmt, dtype, "embedding", result["embedding"], caption=result["caption"])
+
+
+def get_embed_model():
+    # BGE is only needed by /embed, so by default it is loaded on the first call instead of at startup
+    global model2
+    with model2_lock:
+        if model2 is None:
+            path = os.path.join(WEIGHTS_DIR, "bge") if WEIGHTS_DIR else BGE_MODEL
+            model2 = FlagModel(path, use_fp16=torch.cuda.is_available())
+            model2.model.eval()
+            apply_profile(model2.model, PRECISION)
+    return model2
+
+
+def embed_texts(texts):
+    embed_model = get_embed_model()
+    texts = [f"{EMBED_PROMPT} {text}" for text in texts]
+    return encode_texts(embed_model.model, embed_model.tokenizer, texts, EMBED_MAX_BATCH_TOKENS, EMBED_MAX_LENGTH,
+                        EMBED_MAX_BATCH_SIZE)
+
+
 @app.route("/embed", methods=["POST"])
 def embed_text():
+    return traced("embed", embed_traced)
+
+
+def embed_traced(trace):
     data = request.get_json()
     texts = data.get("texts", [])
+    if isinstance(texts, str):
+        texts = [texts]
 
     if not texts:
         return jsonify({"error": "No text provided"}), 400
-    prompt = "Represent this sentence for semantic search:"
-    embedded = model2.encode([f"{prompt} {texts}"])
-    embedded_tensor = torch.tensor(embedded)
-    normal  = F.normalize(embedded_tensor, p=2, dim=1)
-    print(normal)
-    return jsonify({
-        "embedding": normal[0].tolist()
-    })
+    if len(texts) > EMBED_MAX_TEXTS:
+        return jsonify({"error": f"At most {EMBED_MAX_TEXTS} texts per request"}), 413
+    try:
+        fmt, dtype = response_format()
+    except codec.FormatError as e:
+        return jsonify({"error": str(e)}), 400
+
+    texts = [normalize_text(str(text)) for text in texts]
+    keys = [content_key(EMBED_NAMESPACE, text) for text in texts]
+    cached = [result_cache.get(key) for key in keys]
+
+    missing = [i for i, embedding in enumerate(cached) if embedding is None]
+    trace.fields.update(texts=len(texts), cache_misses=len(missing))
+    if missing:
+        # duplicates within one request are encoded once
+        unique = list(dict.fromkeys(texts[i] for i in missing))
+        with trace.stage("embed"):
+            fresh = dict(zip(unique, (embedding.clone() for embedding in embed_texts(unique))))
+        for i in missing:
+            cached[i] = fresh[texts[i]]
+            result_cache.put(keys[i], cached[i])
+
+    with trace.stage("serialize"):
+        embeddings = torch.stack(cached)
+        if fmt != "json":
+            return embedding_response(fmt, dtype, "embeddings", embeddings)
+
+        embeddings = embeddings.tolist()
+        return jsonify({
+            # "embedding" is kept for single-text callers
+            "embedding": embeddings[0],
+            "embeddings": embeddings
+        })
+
+
+@app.route("/cache", methods=["GET"])
+def cache_info():
+    return jsonify(result_cache.info())
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(registry.render(), content_type="text/plain; version=0.0.4")
+
+
+registry.register(metrics.Gauge("blip_cache_events_total", "Result cache hits, disk hits, misses and evictions.",
+                                lambda: {(k,): v for k, v in result_cache.stats.items()}, ["event"], kind="counter"))
+registry.register(metrics.Gauge("blip_startup_seconds", "Seconds from process start to loaded models and to ready.",
+                                lambda: {("load",): startup["load_seconds"], ("ready",): startup["startup_seconds"]},
+                                ["phase"]))
+registry.register(metrics.Gauge("blip_ready", "1 once warmup has finished.", lambda: int(startup["ready"])))
+if NUM_WORKERS > 1:
+    registry.register(metrics.Gauge("blip_workers_alive", "Analyze worker processes alive.", analyze_batcher.alive))
+    registry.register(metrics.Gauge("blip_worker_restarts_total", "Analyze worker processes replaced after exiting.",
+                                    lambda: analyze_batcher.restarts, kind="counter"))
+
+
+@app.route("/health", methods=["GET"])
+def health():
+    status = "ready" if startup["ready"] else "failed" if startup.get("error") else "starting"
+    return jsonify(dict(startup, status=status)), 200 if startup["ready"] else 503
+
+
+def finish_startup():
+    if NUM_WORKERS > 1:
+        # every worker runs warmup_analyze before taking requests
+        analyze_batcher.ready.wait()
+        if analyze_batcher.error:
+            # /health keeps answering 503, with the reason
+            startup["error"] = analyze_batcher.error
+            return
+    else:
+        warmup_analyze()
+    if not LAZY_EMBED:
+        embed_texts(["warmup"])
+    startup["startup_seconds"] = time.perf_counter() - START_TIME
+    startup["ready"] = True
+    print("ready after %.1fs (models loaded in %.1fs)" % (startup["startup_seconds"], LOAD_SECONDS))
+
+
+# the server answers /health with 503 while this runs
+threading.Thread(target=finish_startup, name="startup", daemon=True).start()
+
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000)
+    app.run(host="0.0.0.0", port=5000, threaded=True)
@@ -9,7 +9,8 @@ import warnings
 warnings.filterwarnings("ignore")
 
 from models.vit import VisionTransformer, interpolate_pos_embed
-from models.med import BertConfig, BertModel, BertLMHeadModel
+from models.med import BertConfig, BertModel, BertLMHeadModel, StaticKVCache
+from models import decoding
 from transformers import BertTokenizer
 
 import torch
@@ -17,6 +18,7 @@ from torch import nn
 import torch.nn.functional as F
 
 import os
+from collections import OrderedDict
 from urllib.parse import urlparse
 from timm.models.hub import download_cached_file
 
@@ -83,16 +85,22 @@ class BLIP_Decoder(nn.Module):
                  vit_grad_ckpt = False,
                  vit_ckpt_layer = 0,
                  prompt = 'a picture of ',
+                 prompt_cache_size = 16,
+                 token_merge_ratio = 0.,
                  ):
         """
         Args:
             med_config (str): path for the mixture of encoder-decoder model's configuration file
             image_size (int): input image size
             vit (str): model size of vision transformer
+            prompt (str): caption prefix the decoder is trained with and generates from
+            prompt_cache_size (int): number of distinct prompts whose decoder input ids are kept
+            token_merge_ratio (float): fraction of image tokens merged per ViT block, fewer tokens to cross-attend to
         """            
         super().__init__()
         
-        self.visual_encoder, vision_width = create_vit(vit,image_size, vit_grad_ckpt, vit_ckpt_layer)
+        self.visual_encoder, vision_width = create_vit(vit,image_size, vit_grad_ckpt, vit_ckpt_layer,
+                                                       token_merge_ratio=token_merge_ratio)
         self.tokenizer = init_tokenizer()   
         med_config = BertConfig.from_json_file(med_config)
         med_config.encoder_width = vision_width
@@ -100,12 +108,14 @@ class BLIP_Decoder(nn.Module):
         
         self.prompt = prompt
         self.prompt_length = len(self.tokenizer(self.prompt).input_ids)-1
+        self.prompt_cache = OrderedDict()
+        self.prompt_cache_size = prompt_cache_size
+        self.prompt_ids(self.prompt)
 
         
     def forward(self, image, caption):
         
-        image_embeds = self.visual_encoder(image) 
-        image_atts = torch.ones(image_embeds.size()[:-1],dtype=torch.long).to(image.device)
+        image_embeds, image_atts = self.visual_encoder(image, return_atts=True)
         
         text = self.tokenizer(caption, padding='longest', truncation=True, max_length=40, return_tensors="pt").to(image.device) 
         
@@ -125,21 +135,57 @@ class BLIP_Decoder(nn.Module):
         
         return loss_lm
         
-    def generate(self, image, sample=False, num_beams=3, max_length=30, min_length=10, top_p=0.9, repetition_penalty=1.0):
-        image_embeds = self.visual_encoder(image)
+    def prompt_ids(self, prompt):
+        # decoder input ids of a prompt ([DEC] + prompt tokens, no [SEP]), kept in a small LRU keyed by the prompt
+        input_ids = self.prompt_cache.get(prompt)
+        if input_ids is None:
+            input_ids = self.tokenizer(prompt, return_tensors="pt").input_ids
+            input_ids[:,0] = self.tokenizer.bos_token_id
+            input_ids = input_ids[:, :-1]
+            self.prompt_cache[prompt] = input_ids
+            if len(self.prompt_cache) > self.prompt_cache_size:
+                self.prompt_cache.popitem(last=False)
+        else:
+            self.prompt_cache.move_to_end(prompt)
+        return input_ids
 
-        if not sample:
-            image_embeds = image_embeds.repeat_interleave(num_beams,dim=0)
-            
-        image_atts = torch.ones(image_embeds.size()[:-1],dtype=torch.long).to(image.device)
+    def generate(self, image, sample=False, num_beams=3, max_length=30, min_length=10, top_p=0.9, repetition_penalty=1.0,
+                 static_cache=False, prompt=None, native=None):
+        """
+        Args:
+            static_cache (bool): decode with transformers generate() and a preallocated StaticKVCache instead of a
+                cache grown every step
+            prompt (str): caption prefix to generate from, self.prompt by default
+            native (bool): decode with models.decoding instead of transformers generate(); same captions. By
+                default native unless static_cache is set; native=True with static_cache=True is an error
+        """
+        if native is None:
+            native = not static_cache
+        elif native and static_cache:
+            raise ValueError("static_cache applies to transformers generate(), it cannot be combined with native=True")
+        prompt = self.prompt if prompt is None else prompt
+        # one copy of image_embeds per image: the decoder's cross-attention broadcasts it over the beams
+        image_embeds, image_atts = self.visual_encoder(image, return_atts=True)
         model_kwargs = {"encoder_hidden_states": image_embeds, "encoder_attention_mask":image_atts}
         
-        prompt = [self.prompt] * image.size(0)
-        input_ids = self.tokenizer(prompt, return_tensors="pt").input_ids.to(image.device) 
-        input_ids[:,0] = self.tokenizer.bos_token_id
-        input_ids = input_ids[:, :-1] 
+        input_ids = self.prompt_ids(prompt).to(image.device).repeat(image.size(0), 1)
 
-        if sample:
+        if static_cache:
+            batch_size = image.size(0) if sample else image.size(0) * num_beams
+            model_kwargs["past_key_values"] = StaticKVCache(self.text_decoder.config, batch_size, max_length,
+                                                            device=image.device, dtype=image_embeds.dtype)
+
+        if native:
+            outputs = decoding.generate(self.text_decoder, input_ids, image_embeds, image_atts,
+                                        max_length=max_length,
+                                        min_length=min_length,
+                                        num_beams=num_beams,
+                                        sample=sample,
+                                        top_p=top_p,
+                                        repetition_penalty=1.1 if sample else repetition_penalty,
+                                        eos_token_id=self.tokenizer.sep_token_id,
+                                        pad_token_id=self.tokenizer.pad_token_id)
+        elif sample:
             #nucleus sampling
             outputs = self.text_decoder.generate(input_ids=input_ids,
                                                   max_length=max_length,
@@ -165,7 +211,7 @@ class BLIP_Decoder(nn.Module):
         captions = []    
         for output in outputs:
             caption = self.tokenizer.decode(output, skip_special_tokens=True)    
-            captions.append(caption[len(self.prompt):])
+            captions.append(caption[len(prompt):])
         return captions
     
 
@@ -191,23 +237,73 @@ def init_tokenizer():
     return tokenizer
 
 
-def create_vit(vit, image_size, use_grad_checkpointing=False, ckpt_layer=0, drop_path_rate=0):
+def create_vit(vit, image_size, use_grad_checkpointing=False, ckpt_layer=0, drop_path_rate=0, token_merge_ratio=0.):
         
     assert vit in ['base', 'large'], "vit parameter must be base or large"
     if vit=='base':
         vision_width = 768
         visual_encoder = VisionTransformer(img_size=image_size, patch_size=16, embed_dim=vision_width, depth=12, 
                                            num_heads=12, use_grad_checkpointing=use_grad_checkpointing, ckpt_layer=ckpt_layer,
-                                           drop_path_rate=0 or drop_path_rate
+                                           drop_path_rate=0 or drop_path_rate, token_merge_ratio=token_merge_ratio
                                           )   
     elif vit=='large':
         vision_width = 1024
         visual_encoder = VisionTransformer(img_size=image_size, patch_size=16, embed_dim=vision_width, depth=24, 
                                            num_heads=16, use_grad_checkpointing=use_grad_checkpointing, ckpt_layer=ckpt_layer,
-                                           drop_path_rate=0.1 or drop_path_rate
+                                           drop_path_rate=0.1 or drop_path_rate, token_merge_ratio=token_merge_ratio
                                           )   
     return visual_encoder, vision_width
 
+@torch.no_grad()
+def itm_scores(text_encoder, itm_head, input_ids, attention_mask, image_key_values=None, image_atts=None,
+               batch_size=128, image_embeds=None):
+    """
+    ITM logits [n, 2] of n text-image pairs, n texts against one image or one text against n images (or n
+    aligned pairs). The images are given either as image_embeds, whose cross-attention keys/values are projected
+    batch_size images at a time, or as text_encoder.cross_key_values(image_embeds), computed once by the caller
+    to score the same images against several text batches. Either way a single image's keys/values are projected
+    once and shared by the whole text batch instead of being replicated.
+    Args:
+        input_ids (LongTensor): [n or 1, length] text ids, starting with [ENC]
+        attention_mask (LongTensor): [n or 1, length] text attention mask
+        image_key_values (tuple): cross_key_values() of [n or 1, image_length, width] image embeddings
+        image_atts (LongTensor): [n or 1, image_length] image attention mask, all ones if None
+        batch_size (int): pairs per text encoder pass, and images per key/value projection
+        image_embeds (Tensor): [n or 1, image_length, width] image embeddings, in place of image_key_values
+    """
+    assert (image_key_values is None) != (image_embeds is None), "give either image_key_values or image_embeds"
+    num_texts = input_ids.size(0)
+    num_images = image_key_values[0][0].size(0) if image_embeds is None else image_embeds.size(0)
+    num_pairs = max(num_texts, num_images)
+    assert num_texts in (1, num_pairs) and num_images in (1, num_pairs), \
+        "%d texts cannot be paired with %d images" % (num_texts, num_images)
+    if image_embeds is not None and num_images == 1:
+        image_key_values = text_encoder.cross_key_values(image_embeds)
+
+    logits = []
+    for start in range(0, num_pairs, batch_size):
+        end = min(start + batch_size, num_pairs)
+        if num_texts == 1:
+            text_ids, text_atts = input_ids.expand(end - start, -1), attention_mask.expand(end - start, -1)
+        else:
+            text_ids, text_atts = input_ids[start:end], attention_mask[start:end]
+        key_values, atts = image_key_values, image_atts
+        if num_images > 1:
+            if image_embeds is not None:
+                key_values = text_encoder.cross_key_values(image_embeds[start:end])
+            else:
+                key_values = tuple((key[start:end], value[start:end]) for key, value in image_key_values)
+            atts = image_atts[start:end] if image_atts is not None else None
+        output = text_encoder(text_ids,
+                              attention_mask = text_atts,
+                              encoder_key_values = key_values,
+                              encoder_attention_mask = atts,
+                              return_dict = True,
+                             )
+        logits.append(itm_head(output.last_hidden_state[:,0,:]))
+    return torch.cat(logits)
+
+
 def is_url(url_or_filename):
     parsed = urlparse(url_or_filename)
     return parsed.scheme in ("http", "https")
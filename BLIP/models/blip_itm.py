@@ -1,11 +1,10 @@
 from models.med import BertConfig, BertModel
 from transformers import BertTokenizer
 
-import torch
 from torch import nn
 import torch.nn.functional as F
 
-from models.blip import create_vit, init_tokenizer, load_checkpoint
+from models.blip import create_vit, init_tokenizer, load_checkpoint, itm_scores
 
 class BLIP_ITM(nn.Module):
     def __init__(self,                 
@@ -15,19 +14,23 @@ class BLIP_ITM(nn.Module):
                  vit_grad_ckpt = False,
                  vit_ckpt_layer = 0,                      
                  embed_dim = 256,     
+                 token_merge_ratio = 0.,
                  ):
         """
         Args:
             med_config (str): path for the mixture of encoder-decoder model's configuration file
             image_size (int): input image size
             vit (str): model size of vision transformer
+            token_merge_ratio (float): fraction of image tokens merged per ViT block, fewer tokens to cross-attend to
         """               
         super().__init__()
         
-        self.visual_encoder, vision_width = create_vit(vit,image_size, vit_grad_ckpt, vit_ckpt_layer)
+        self.visual_encoder, vision_width = create_vit(vit,image_size, vit_grad_ckpt, vit_ckpt_layer,
+                                                       token_merge_ratio=token_merge_ratio)
         self.tokenizer = init_tokenizer()   
         med_config = BertConfig.from_json_file(med_config)
         med_config.encoder_width = vision_width
+        med_config.unpad_inputs = True
         self.text_encoder = BertModel(config=med_config, add_pooling_layer=False)          
 
         text_width = self.text_encoder.config.hidden_size
@@ -40,10 +43,9 @@ class BLIP_ITM(nn.Module):
         
     def forward(self, image, caption, match_head='itm'):
 
-        image_embeds = self.visual_encoder(image) 
-        image_atts = torch.ones(image_embeds.size()[:-1],dtype=torch.long).to(image.device)        
+        image_embeds, image_atts = self.visual_encoder(image, return_atts=True)
       
-        text = self.tokenizer(caption, padding='max_length', truncation=True, max_length=35, 
+        text = self.tokenizer(caption, padding='longest', truncation=True, max_length=35, 
                               return_tensors="pt").to(image.device) 
 
                  
@@ -65,6 +67,15 @@ class BLIP_ITM(nn.Module):
             
             sim = image_feat @ text_feat.t()
             return sim
+
+    def image_key_values(self, image_embeds):
+        # per-layer cross-attention keys/values of the text encoder, for itm_scores()
+        return self.text_encoder.cross_key_values(image_embeds)
+
+    def itm_scores(self, input_ids, attention_mask, image_key_values=None, image_atts=None, batch_size=128,
+                   image_embeds=None):
+        return itm_scores(self.text_encoder, self.itm_head, input_ids, attention_mask, image_key_values, image_atts,
+                          batch_size, image_embeds)
         
         
 def blip_itm(pretrained='',**kwargs):
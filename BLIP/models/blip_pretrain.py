@@ -51,6 +51,7 @@ class BLIP_Pretrain(nn.Module):
         self.tokenizer = init_tokenizer()   
         encoder_config = BertConfig.from_json_file(med_config)
         encoder_config.encoder_width = vision_width
+        encoder_config.unpad_inputs = True
         self.text_encoder = BertModel.from_pretrained('bert-base-uncased',config=encoder_config, add_pooling_layer=False)
         self.text_encoder.resize_token_embeddings(len(self.tokenizer)) 
 
@@ -102,7 +103,7 @@ class BLIP_Pretrain(nn.Module):
         image_atts = torch.ones(image_embeds.size()[:-1],dtype=torch.long).to(image.device)        
         image_feat = F.normalize(self.vision_proj(image_embeds[:,0,:]),dim=-1)          
         
-        text = self.tokenizer(caption, padding='max_length', truncation=True, max_length=30, 
+        text = self.tokenizer(caption, padding='longest', truncation=True, max_length=30, 
                               return_tensors="pt").to(image.device)  
         text_output = self.text_encoder(text.input_ids, attention_mask = text.attention_mask,                      
                                         return_dict = True, mode = 'text')            
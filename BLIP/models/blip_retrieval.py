@@ -5,7 +5,7 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 
-from models.blip import create_vit, init_tokenizer, load_checkpoint
+from models.blip import create_vit, init_tokenizer, load_checkpoint, itm_scores
 
 class BLIP_Retrieval(nn.Module):
     def __init__(self,                 
@@ -31,6 +31,7 @@ class BLIP_Retrieval(nn.Module):
         self.tokenizer = init_tokenizer()   
         med_config = BertConfig.from_json_file(med_config)
         med_config.encoder_width = vision_width
+        med_config.unpad_inputs = True
         self.text_encoder = BertModel(config=med_config, add_pooling_layer=False)          
 
         text_width = self.text_encoder.config.hidden_size
@@ -77,6 +78,8 @@ class BLIP_Retrieval(nn.Module):
         image_atts = torch.ones(image_embeds.size()[:-1],dtype=torch.long).to(image.device)        
         image_feat = F.normalize(self.vision_proj(image_embeds[:,0,:]),dim=-1)    
         
+        # fixed length: the token ids of all ranks are gathered for hard negatives; padding is skipped by
+        # the text encoder instead
         text = self.tokenizer(caption, padding='max_length', truncation=True, max_length=35, 
                               return_tensors="pt").to(image.device) 
         
@@ -223,6 +226,15 @@ class BLIP_Retrieval(nn.Module):
         loss_itm = F.cross_entropy(vl_output, itm_labels)     
 
         return loss_ita, loss_itm 
+
+    def image_key_values(self, image_embeds):
+        # per-layer cross-attention keys/values of the text encoder, for itm_scores()
+        return self.text_encoder.cross_key_values(image_embeds)
+
+    def itm_scores(self, input_ids, attention_mask, image_key_values=None, image_atts=None, batch_size=128,
+                   image_embeds=None):
+        return itm_scores(self.text_encoder, self.itm_head, input_ids, attention_mask, image_key_values, image_atts,
+                          batch_size, image_embeds)
  
 
     @torch.no_grad()    
@@ -1,11 +1,10 @@
-from models.med import BertConfig, BertModel, BertLMHeadModel
+from models.med import BertConfig, BertModel, BertLMHeadModel, StaticKVCache
 from models.blip import create_vit, init_tokenizer, load_checkpoint
 
 import torch
 from torch import nn
 import torch.nn.functional as F
 from transformers import BertTokenizer
-import numpy as np
 
 class BLIP_VQA(nn.Module):
     def __init__(self,                 
@@ -14,16 +13,19 @@ class BLIP_VQA(nn.Module):
                  vit = 'base',
                  vit_grad_ckpt = False,
                  vit_ckpt_layer = 0,                   
+                 token_merge_ratio = 0.,
                  ):
         """
         Args:
             med_config (str): path for the mixture of encoder-decoder model's configuration file
             image_size (int): input image size
             vit (str): model size of vision transformer
+            token_merge_ratio (float): fraction of image tokens merged per ViT block, fewer tokens to cross-attend to
         """               
         super().__init__()
         
-        self.visual_encoder, vision_width = create_vit(vit, image_size, vit_grad_ckpt, vit_ckpt_layer, drop_path_rate=0.1)
+        self.visual_encoder, vision_width = create_vit(vit, image_size, vit_grad_ckpt, vit_ckpt_layer, drop_path_rate=0.1,
+                                                       token_merge_ratio=token_merge_ratio)
         self.tokenizer = init_tokenizer()  
         
         encoder_config = BertConfig.from_json_file(med_config)
@@ -34,10 +36,10 @@ class BLIP_VQA(nn.Module):
         self.text_decoder = BertLMHeadModel(config=decoder_config)          
 
 
-    def forward(self, image, question, answer=None, n=None, weights=None, train=True, inference='rank', k_test=128):
+    def forward(self, image, question, answer=None, n=None, weights=None, train=True, inference='rank', k_test=128,
+                static_cache=False):
         
-        image_embeds = self.visual_encoder(image) 
-        image_atts = torch.ones(image_embeds.size()[:-1],dtype=torch.long).to(image.device)
+        image_embeds, image_atts = self.visual_encoder(image, return_atts=True)
         
         question = self.tokenizer(question, padding='longest', truncation=True, max_length=35, 
                                   return_tensors="pt").to(image.device) 
@@ -90,14 +92,20 @@ class BLIP_VQA(nn.Module):
             
             if inference=='generate':
                 num_beams = 3
-                question_states = question_output.last_hidden_state.repeat_interleave(num_beams,dim=0)
+                # one copy of the question states per question, broadcast over the beams by the decoder
+                question_states = question_output.last_hidden_state
                 question_atts = torch.ones(question_states.size()[:-1],dtype=torch.long).to(question_states.device)
                 model_kwargs = {"encoder_hidden_states": question_states, "encoder_attention_mask":question_atts}
                 
                 bos_ids = torch.full((image.size(0),1),fill_value=self.tokenizer.bos_token_id,device=image.device)
+                max_length = 10
+                if static_cache:
+                    model_kwargs["past_key_values"] = StaticKVCache(self.text_decoder.config, image.size(0) * num_beams,
+                                                                    max_length, device=image.device,
+                                                                    dtype=question_states.dtype)
                 
                 outputs = self.text_decoder.generate(input_ids=bos_ids,
-                                                     max_length=10,
+                                                     max_length=max_length,
                                                      min_length=1,
                                                      num_beams=num_beams,
                                                      eos_token_id=self.tokenizer.sep_token_id,
@@ -146,10 +154,7 @@ class BLIP_VQA(nn.Module):
 
         targets_ids = input_ids.masked_fill(input_ids == self.tokenizer.pad_token_id, -100)
 
-        # repeat encoder's output for top-k answers
-        question_states = tile(question_states, 0, k)
-        question_atts = tile(question_atts, 0, k)
-        
+        # the decoder's cross-attention broadcasts each question's states over its k answers
         output = self.text_decoder(input_ids, 
                                    attention_mask = input_atts, 
                                    encoder_hidden_states = question_states,
@@ -174,13 +179,3 @@ def blip_vqa(pretrained='',**kwargs):
 #         assert(len(msg.missing_keys)==0)
     return model  
 
-
-def tile(x, dim, n_tile):
-    init_dim = x.size(dim)
-    repeat_idx = [1] * x.dim()
-    repeat_idx[dim] = n_tile
-    x = x.repeat(*(repeat_idx))
-    order_index = torch.LongTensor(np.concatenate([init_dim * np.arange(n_tile) + i for i in range(init_dim)]))
-    return torch.index_select(x, dim, order_index.to(x.device))    
-        
-        
\ No newline at end of file
@@ -0,0 +1,245 @@
+'''
+Greedy, beam and nucleus decoding for the MED BertLMHeadModel, in place of transformers' generate().
+
+Results follow transformers 4.15 generate() with the settings BLIP uses (repetition penalty, min_length,
+top_k=50 / top_p sampling, length_penalty=1.0 beam search without early stopping), token for token and for the
+same seed. The loop computes logits for the last position only, keeps the cross-attention keys/values in the
+cache and never replicates encoder states per beam, and drops finished greedy rows and finished beam groups from
+the batch instead of decoding pad tokens for them.
+'''
+import torch
+import torch.nn.functional as F
+
+
+class BeamHypotheses:
+    def __init__(self, num_beams, length_penalty=1.0):
+        self.num_beams = num_beams
+        self.length_penalty = length_penalty
+        self.beams = []
+        self.worst_score = 1e9
+
+    def __len__(self):
+        return len(self.beams)
+
+    def add(self, hyp, sum_logprobs):
+        score = sum_logprobs / (hyp.size(-1) ** self.length_penalty)
+        if len(self) < self.num_beams or score > self.worst_score:
+            self.beams.append((score, hyp))
+            if len(self) > self.num_beams:
+                sorted_scores = sorted([(s, idx) for idx, (s, _) in enumerate(self.beams)])
+                del self.beams[sorted_scores[0][1]]
+                self.worst_score = sorted_scores[1][0]
+            else:
+                self.worst_score = min(score, self.worst_score)
+
+    def is_done(self, best_sum_logprobs, cur_len):
+        if len(self) < self.num_beams:
+            return False
+        return self.worst_score >= best_sum_logprobs / cur_len ** self.length_penalty
+
+    def best(self):
+        return sorted(self.beams, key=lambda x: x[0])[-1][1]
+
+
+def decoder_step(decoder, input_ids, encoder_hidden_states, encoder_attention_mask, past_key_values):
+    # next-token logits [batch, vocab] from the last position only, and the updated cache
+    outputs = decoder.bert(input_ids,
+                           encoder_hidden_states = encoder_hidden_states,
+                           encoder_attention_mask = encoder_attention_mask,
+                           past_key_values = past_key_values,
+                           use_cache = True,
+                           return_dict = True,
+                           is_decoder = True,
+                          )
+    logits = decoder.cls(outputs.last_hidden_state[:, -1, :])
+    return logits, outputs.past_key_values
+
+
+def select_cache(past_key_values, rows, groups):
+    # keep cache rows `rows`; cross-attention entries given once per image keep the image indices `groups` instead
+    num_rows = past_key_values[0][0].size(0)
+    selected = ()
+    for layer_past in past_key_values:
+        layer_past = tuple(state.index_select(0, rows) for state in layer_past[:2]) + \
+                     tuple(state.index_select(0, rows if state.size(0) == num_rows else groups) for state in layer_past[2:])
+        selected += (layer_past,)
+    return selected
+
+
+def process_scores(scores, input_ids, cur_len, min_length, repetition_penalty, eos_token_id):
+    if repetition_penalty != 1.0:
+        score = torch.gather(scores, 1, input_ids)
+        score = torch.where(score < 0, score * repetition_penalty, score / repetition_penalty)
+        scores.scatter_(1, input_ids, score)
+    if cur_len < min_length:
+        scores[:, eos_token_id] = -float("inf")
+    return scores
+
+
+def warp_scores(scores, top_k, top_p):
+    if top_k > 0:
+        top_k = min(top_k, scores.size(-1))
+        scores = scores.masked_fill(scores < torch.topk(scores, top_k)[0][..., -1, None], -float("inf"))
+    if top_p < 1.0:
+        sorted_logits, sorted_indices = torch.sort(scores, descending=True)
+        cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+        # keep the smallest set of tokens whose probability reaches top_p, and at least one token
+        sorted_indices_to_remove = cumulative_probs > top_p
+        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
+        sorted_indices_to_remove[..., 0] = 0
+        indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
+        scores = scores.masked_fill(indices_to_remove, -float("inf"))
+    return scores
+
+
+@torch.no_grad()
+def generate(decoder, input_ids, encoder_hidden_states, encoder_attention_mask=None, max_length=30, min_length=10,
+             num_beams=1, sample=False, top_k=50, top_p=1.0, repetition_penalty=1.0, eos_token_id=102, pad_token_id=0):
+    """
+    Args:
+        decoder (BertLMHeadModel): text decoder with cross-attention
+        input_ids (LongTensor): [batch, prompt_length] prompt ids, the same length for every row
+        encoder_hidden_states (Tensor): [batch, encoder_length, width], one row per prompt row (not per beam)
+        num_beams (int): beam search with this many beams if > 1 and not sampling, greedy search if 1
+        sample (bool): nucleus sampling with top_k / top_p; every row is kept to the end so the random stream
+            matches transformers for the same seed
+    Returns:
+        LongTensor [batch, length] of prompt + generated ids, padded with pad_token_id
+    """
+    if encoder_attention_mask is None:
+        encoder_attention_mask = torch.ones(encoder_hidden_states.size()[:-1], dtype=torch.long,
+                                            device=encoder_hidden_states.device)
+    if num_beams > 1 and not sample:
+        return beam_search(decoder, input_ids, encoder_hidden_states, encoder_attention_mask, num_beams, max_length,
+                           min_length, repetition_penalty, eos_token_id, pad_token_id)
+    return greedy_search(decoder, input_ids, encoder_hidden_states, encoder_attention_mask, max_length, min_length,
+                         repetition_penalty, eos_token_id, pad_token_id, sample, top_k, top_p)
+
+
+def greedy_search(decoder, input_ids, encoder_hidden_states, encoder_attention_mask, max_length, min_length,
+                  repetition_penalty, eos_token_id, pad_token_id, sample=False, top_k=50, top_p=1.0):
+    batch_size, cur_len = input_ids.size()
+    device = input_ids.device
+    unfinished = torch.ones(batch_size, dtype=torch.bool, device=device)
+    rows = torch.arange(batch_size, device=device)  # rows still being decoded
+    step_ids, past_key_values = input_ids, None
+
+    while cur_len < max_length:
+        logits, past_key_values = decoder_step(decoder, step_ids, encoder_hidden_states, encoder_attention_mask,
+                                               past_key_values)
+        scores = process_scores(logits, input_ids[rows], cur_len, min_length, repetition_penalty, eos_token_id)
+        if sample:
+            probs = F.softmax(warp_scores(scores, top_k, top_p), dim=-1)
+            next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+        else:
+            next_tokens = torch.argmax(scores, dim=-1)
+        next_tokens = next_tokens.masked_fill(~unfinished[rows], pad_token_id)
+
+        tokens = input_ids.new_full((batch_size,), pad_token_id)
+        tokens[rows] = next_tokens
+        input_ids = torch.cat([input_ids, tokens[:, None]], dim=-1)
+        cur_len += 1
+        unfinished[rows] &= next_tokens != eos_token_id
+        if not unfinished.any():
+            break
+
+        keep = unfinished[rows]
+        if not sample and not keep.all():
+            # finished rows leave the batch; sampling keeps them so the random stream stays the same
+            keep = keep.nonzero().squeeze(1)
+            rows, next_tokens = rows[keep], next_tokens[keep]
+            past_key_values = select_cache(past_key_values, keep, keep)
+            encoder_hidden_states = encoder_hidden_states.index_select(0, keep)
+            encoder_attention_mask = encoder_attention_mask.index_select(0, keep)
+        step_ids = next_tokens[:, None]
+    return input_ids
+
+
+def beam_search(decoder, input_ids, encoder_hidden_states, encoder_attention_mask, num_beams, max_length, min_length,
+                repetition_penalty, eos_token_id, pad_token_id, length_penalty=1.0):
+    batch_size = input_ids.size(0)
+    device = input_ids.device
+    input_ids = input_ids.repeat_interleave(num_beams, dim=0)
+    cur_len = input_ids.size(1)
+    beam_scores = torch.zeros(batch_size, num_beams, device=device)
+    beam_scores[:, 1:] = -1e9
+    beam_scores = beam_scores.view(-1)
+
+    hypotheses = [BeamHypotheses(num_beams, length_penalty) for _ in range(batch_size)]
+    done = [False] * batch_size
+    images = list(range(batch_size))  # images still being searched, num_beams consecutive rows each
+    beam_offsets = torch.arange(num_beams, device=device)
+    step_ids, past_key_values = input_ids, None
+
+    while cur_len < max_length:
+        logits, past_key_values = decoder_step(decoder, step_ids, encoder_hidden_states, encoder_attention_mask,
+                                               past_key_values)
+        scores = F.log_softmax(logits, dim=-1)
+        scores = process_scores(scores, input_ids, cur_len, min_length, repetition_penalty, eos_token_id)
+        scores = scores + beam_scores[:, None]
+        vocab_size = scores.size(-1)
+        scores = scores.view(len(images), num_beams * vocab_size)
+
+        top_scores, top_tokens = torch.topk(scores, 2 * num_beams, dim=1, largest=True, sorted=True)
+        top_indices = (top_tokens // vocab_size).tolist()
+        top_tokens = (top_tokens % vocab_size).tolist()
+        top_score_values = top_scores.tolist()
+
+        next_scores, next_tokens, next_rows = [], [], []
+        for i, image in enumerate(images):
+            num_kept = 0
+            for rank, (token, score, index) in enumerate(zip(top_tokens[i], top_score_values[i], top_indices[i])):
+                row = i * num_beams + index
+                if token == eos_token_id:
+                    # an end of sentence only counts if it is among the num_beams best candidates
+                    if rank >= num_beams:
+                        continue
+                    hypotheses[image].add(input_ids[row].clone(), score)
+                else:
+                    next_scores.append(score)
+                    next_tokens.append(token)
+                    next_rows.append(row)
+                    num_kept += 1
+                if num_kept == num_beams:
+                    break
+            done[image] = hypotheses[image].is_done(max(top_score_values[i]), cur_len)
+
+        beam_idx = torch.tensor(next_rows, device=device)
+        beam_scores = top_scores.new_tensor(next_scores)
+        next_tokens = input_ids.new_tensor(next_tokens)
+        input_ids = torch.cat([input_ids.index_select(0, beam_idx), next_tokens[:, None]], dim=-1)
+        cur_len += 1
+        if all(done):
+            break
+
+        # every beam of an image shares its cross-attention keys/values, so only self-attention entries move
+        past_key_values = tuple(tuple(state.index_select(0, beam_idx) for state in layer_past[:2]) + layer_past[2:]
+                                for layer_past in past_key_values)
+        keep = [i for i, image in enumerate(images) if not done[image]]
+        if len(keep) < len(images):
+            # finished images leave the batch
+            groups = torch.tensor(keep, device=device)
+            rows = (groups[:, None] * num_beams + beam_offsets).view(-1)
+            images = [images[i] for i in keep]
+            input_ids, beam_scores, next_tokens = input_ids[rows], beam_scores[rows], next_tokens[rows]
+            past_key_values = select_cache(past_key_values, rows, groups)
+            encoder_rows = rows if encoder_hidden_states.size(0) == len(beam_idx) else groups
+            encoder_hidden_states = encoder_hidden_states.index_select(0, encoder_rows)
+            encoder_attention_mask = encoder_attention_mask.index_select(0, encoder_rows)
+        step_ids = next_tokens[:, None]
+
+    for i, image in enumerate(images):
+        if done[image]:
+            continue
+        for beam in range(num_beams):
+            row = i * num_beams + beam
+            hypotheses[image].add(input_ids[row], beam_scores[row].item())
+
+    best = [hypothesis.best() for hypothesis in hypotheses]
+    lengths = [hyp.size(0) for hyp in best]
+    decoded = input_ids.new_full((batch_size, min(max(lengths) + 1, max_length)), pad_token_id)
+    for i, hyp in enumerate(best):
+        decoded[i, :lengths[i]] = hyp
+        if lengths[i] < max_length:
+            decoded[i, lengths[i]] = eos_token_id
+    return decoded
@@ -76,9 +76,8 @@ class BertEmbeddings(nn.Module):
         else:
             input_shape = inputs_embeds.size()[:-1]
 
-        seq_length = input_shape[1]
-
         if position_ids is None:
+            seq_length = input_shape[1]
             position_ids = self.position_ids[:, past_key_values_length : seq_length + past_key_values_length]
 
         if inputs_embeds is None:
@@ -94,6 +93,92 @@ class BertEmbeddings(nn.Module):
         return embeddings
 
 
+class StaticKVCache:
+    """
+    Decoder self-attention cache backed by one preallocated [layers, batch, heads, max_length, head_size] buffer
+    for keys and one for values. Each step writes its keys/values in place and beam search reorders the buffers
+    in place, instead of concatenating new tensors every step. Pass it as past_key_values; the model returns the
+    same object, advanced by the number of tokens it consumed.
+    """
+
+    def __init__(self, config, batch_size, max_length, device=None, dtype=torch.float32):
+        head_size = config.hidden_size // config.num_attention_heads
+        shape = (config.num_hidden_layers, batch_size, config.num_attention_heads, max_length, head_size)
+        self.key = torch.zeros(shape, device=device, dtype=dtype)
+        self.value = torch.zeros(shape, device=device, dtype=dtype)
+        # cross-attention keys/values, computed on the first step
+        self.cross_key_values = [None] * config.num_hidden_layers
+        self.max_length = max_length
+        self.length = 0
+
+    def __len__(self):
+        return self.key.size(0)
+
+    def __getitem__(self, layer):
+        return StaticLayerCache(self, layer)
+
+    def update(self, layer, key_layer, value_layer):
+        end = self.length + key_layer.size(2)
+        if end > self.max_length:
+            raise ValueError("StaticKVCache holds %d tokens, %d were given" % (self.max_length, end))
+        self.key[layer, :, :, self.length:end] = key_layer
+        self.value[layer, :, :, self.length:end] = value_layer
+        return self.key[layer, :, :, :end], self.value[layer, :, :, :end]
+
+    def advance(self, num_tokens):
+        self.length += num_tokens
+
+    def reorder(self, beam_idx):
+        # beams only move within their own image, so the cross-attention entries stay as they are
+        for cache in (self.key, self.value):
+            cache[:, :, :, :self.length] = cache[:, :, :, :self.length].index_select(1, beam_idx)
+        return self
+
+    # name used by newer transformers releases for caches that are not tuples
+    reorder_cache = reorder
+
+
+class StaticLayerCache:
+    """ The entries of one layer of a StaticKVCache. """
+
+    def __init__(self, cache, layer):
+        self.cache = cache
+        self.layer = layer
+
+    def update(self, key_layer, value_layer):
+        return self.cache.update(self.layer, key_layer, value_layer)
+
+    @property
+    def cross_key_value(self):
+        return self.cache.cross_key_values[self.layer]
+
+    @cross_key_value.setter
+    def cross_key_value(self, key_value):
+        self.cache.cross_key_values[self.layer] = key_value
+
+
+class UnpaddedBatch:
+    """
+    The non-padding positions of a [batch, seq_length] attention mask. The text encoder runs embeddings,
+    projections and feed-forward layers on the packed [tokens, width] hidden states, and scatters them back to
+    [batch, seq_length, width] only for the attention matmuls, where the padding mask keeps sequences apart.
+    """
+
+    def __init__(self, attention_mask):
+        self.batch_size, self.seq_length = attention_mask.size()
+        self.indices = attention_mask.flatten().nonzero().squeeze(1)
+
+    def unpad(self, x):
+        # [batch, seq_length, ...] -> [tokens, ...]
+        return x.flatten(0, 1).index_select(0, self.indices)
+
+    def pad(self, x):
+        # [tokens, ...] -> [batch, seq_length, ...], zeros at the padding positions
+        padded = x.new_zeros((self.batch_size * self.seq_length,) + x.shape[1:])
+        padded = padded.index_copy(0, self.indices, x)
+        return padded.view((self.batch_size, self.seq_length) + x.shape[1:])
+
+
 class BertSelfAttention(nn.Module):
     def __init__(self, config, is_cross_attention):
         super().__init__()
@@ -108,6 +193,7 @@ class BertSelfAttention(nn.Module):
         self.attention_head_size = int(config.hidden_size / config.num_attention_heads)
         self.all_head_size = self.num_attention_heads * self.attention_head_size
 
+        self.is_cross_attention = is_cross_attention
         self.query = nn.Linear(config.hidden_size, self.all_head_size)
         if is_cross_attention:
             self.key = nn.Linear(config.encoder_width, self.all_head_size)
@@ -122,6 +208,11 @@ class BertSelfAttention(nn.Module):
             self.max_position_embeddings = config.max_position_embeddings
             self.distance_embedding = nn.Embedding(2 * config.max_position_embeddings - 1, self.attention_head_size)
         self.save_attention = False   
+        # "sdpa" computes attention with torch's fused scaled_dot_product_attention whenever the explicit
+        # probabilities are not needed; "eager" always takes the explicit matmul/softmax path
+        self.attention_backend = getattr(config, "attention_backend", "sdpa")
+        if not hasattr(F, "scaled_dot_product_attention"):
+            self.attention_backend = "eager"
             
     def save_attn_gradients(self, attn_gradients):
         self.attn_gradients = attn_gradients
@@ -140,40 +231,29 @@ class BertSelfAttention(nn.Module):
         x = x.view(*new_x_shape)
         return x.permute(0, 2, 1, 3)
 
-    def forward(
-        self,
-        hidden_states,
-        attention_mask=None,
-        head_mask=None,
-        encoder_hidden_states=None,
-        encoder_attention_mask=None,
-        past_key_value=None,
-        output_attentions=False,
-    ):
-        mixed_query_layer = self.query(hidden_states)
-
-        # If this is instantiated as a cross-attention module, the keys
-        # and values come from an encoder; the attention mask needs to be
-        # such that the encoder's padding tokens are not attended to.
-        is_cross_attention = encoder_hidden_states is not None
-
-        if is_cross_attention:
-            key_layer = self.transpose_for_scores(self.key(encoder_hidden_states))
-            value_layer = self.transpose_for_scores(self.value(encoder_hidden_states))
-            attention_mask = encoder_attention_mask
-        elif past_key_value is not None:
-            key_layer = self.transpose_for_scores(self.key(hidden_states))
-            value_layer = self.transpose_for_scores(self.value(hidden_states))
-            key_layer = torch.cat([past_key_value[0], key_layer], dim=2)
-            value_layer = torch.cat([past_key_value[1], value_layer], dim=2)
-        else:
-            key_layer = self.transpose_for_scores(self.key(hidden_states))
-            value_layer = self.transpose_for_scores(self.value(hidden_states))
-
-        query_layer = self.transpose_for_scores(mixed_query_layer)
-
-        past_key_value = (key_layer, value_layer)
-
+    def fold_rows(self, x, num_rows):
+        # [batch * num_rows, heads, length, d] -> [batch, heads, num_rows * length, d]
+        batch_size, num_heads, length, head_size = x.size()
+        x = x.view(batch_size // num_rows, num_rows, num_heads, length, head_size).transpose(1, 2)
+        return x.reshape(batch_size // num_rows, num_heads, num_rows * length, head_size)
+
+    def unfold_rows(self, x, num_rows):
+        # inverse of fold_rows
+        batch_size, num_heads, length, head_size = x.size()
+        x = x.view(batch_size, num_heads, num_rows, length // num_rows, head_size).transpose(1, 2)
+        return x.reshape(batch_size * num_rows, num_heads, length // num_rows, head_size)
+
+    def encoder_key_value(self, encoder_hidden_states):
+        return (self.transpose_for_scores(self.key(encoder_hidden_states)),
+                self.transpose_for_scores(self.value(encoder_hidden_states)))
+
+    def use_sdpa(self, output_attentions, head_mask):
+        # the explicit path is kept for attention maps, head masks and relative position scores
+        return (self.attention_backend == "sdpa" and not output_attentions and not self.save_attention
+                and head_mask is None and self.position_embedding_type == "absolute")
+
+    def explicit_attention(self, query_layer, key_layer, value_layer, attention_mask, head_mask, hidden_states,
+                           is_cross_attention):
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
 
@@ -214,10 +294,86 @@ class BertSelfAttention(nn.Module):
             attention_probs_dropped = attention_probs_dropped * head_mask
 
         context_layer = torch.matmul(attention_probs_dropped, value_layer)
+        return context_layer, attention_probs
+
+    def forward(
+        self,
+        hidden_states,
+        attention_mask=None,
+        head_mask=None,
+        encoder_hidden_states=None,
+        encoder_attention_mask=None,
+        past_key_value=None,
+        output_attentions=False,
+        unpadded=None,
+    ):
+        mixed_query_layer = self.query(hidden_states)
+        if unpadded is not None:
+            mixed_query_layer = unpadded.pad(mixed_query_layer)
+
+        # If this is instantiated as a cross-attention module, the keys
+        # and values come from an encoder; the attention mask needs to be
+        # such that the encoder's padding tokens are not attended to.
+        # (or it is given only the projected keys/values of the encoder states, see BertModel.cross_key_values)
+        is_cross_attention = encoder_hidden_states is not None or (self.is_cross_attention and past_key_value is not None)
+
+        if is_cross_attention and past_key_value is not None:
+            # the encoder states do not change while decoding, so their keys/values are projected once and reused
+            key_layer = past_key_value[0]
+            value_layer = past_key_value[1]
+            attention_mask = encoder_attention_mask
+        elif is_cross_attention:
+            key_layer, value_layer = self.encoder_key_value(encoder_hidden_states)
+            attention_mask = encoder_attention_mask
+        elif isinstance(past_key_value, StaticLayerCache):
+            key_layer, value_layer = past_key_value.update(self.transpose_for_scores(self.key(hidden_states)),
+                                                           self.transpose_for_scores(self.value(hidden_states)))
+        elif past_key_value is not None:
+            key_layer = self.transpose_for_scores(self.key(hidden_states))
+            value_layer = self.transpose_for_scores(self.value(hidden_states))
+            key_layer = torch.cat([past_key_value[0], key_layer], dim=2)
+            value_layer = torch.cat([past_key_value[1], value_layer], dim=2)
+        elif unpadded is not None:
+            key_layer = self.transpose_for_scores(unpadded.pad(self.key(hidden_states)))
+            value_layer = self.transpose_for_scores(unpadded.pad(self.value(hidden_states)))
+        else:
+            key_layer = self.transpose_for_scores(self.key(hidden_states))
+            value_layer = self.transpose_for_scores(self.value(hidden_states))
+
+        query_layer = self.transpose_for_scores(mixed_query_layer)
+
+        past_key_value = (key_layer, value_layer)
+
+        # the encoder states may be given once for several consecutive rows of hidden_states (the beams of an
+        # image, or candidate texts for it); keys and values are then broadcast over those rows, not replicated
+        num_rows_per_key = query_layer.size(0) // key_layer.size(0)
+        if is_cross_attention and num_rows_per_key > 1:
+            if output_attentions or self.save_attention:
+                # attention maps are reported per row
+                key_layer = key_layer.repeat_interleave(num_rows_per_key, dim=0)
+                value_layer = value_layer.repeat_interleave(num_rows_per_key, dim=0)
+                attention_mask = attention_mask.repeat_interleave(num_rows_per_key, dim=0)
+                num_rows_per_key = 1
+            else:
+                # cross-attention queries are independent, so the rows can share one key/value block
+                query_layer = self.fold_rows(query_layer, num_rows_per_key)
+
+        if self.use_sdpa(output_attentions, head_mask):
+            # fused kernel: the [batch, heads, query, key] probabilities are never materialized
+            context_layer = F.scaled_dot_product_attention(query_layer, key_layer, value_layer, attn_mask=attention_mask,
+                                                           dropout_p=self.dropout.p if self.training else 0.)
+        else:
+            context_layer, attention_probs = self.explicit_attention(query_layer, key_layer, value_layer, attention_mask,
+                                                                     head_mask, hidden_states, is_cross_attention)
+
+        if is_cross_attention and num_rows_per_key > 1:
+            context_layer = self.unfold_rows(context_layer, num_rows_per_key)
 
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
         context_layer = context_layer.view(*new_context_layer_shape)
+        if unpadded is not None:
+            context_layer = unpadded.unpad(context_layer)
 
         outputs = (context_layer, attention_probs) if output_attentions else (context_layer,)
 
@@ -273,6 +429,7 @@ class BertAttention(nn.Module):
         encoder_attention_mask=None,
         past_key_value=None,
         output_attentions=False,
+        unpadded=None,
     ):
         self_outputs = self.self(
             hidden_states,
@@ -282,6 +439,7 @@ class BertAttention(nn.Module):
             encoder_attention_mask,
             past_key_value,
             output_attentions,
+            unpadded=unpadded,
         )
         attention_output = self.output(self_outputs[0], hidden_states)
         outputs = (attention_output,) + self_outputs[1:]  # add attentions if we output them
@@ -340,15 +498,22 @@ class BertLayer(nn.Module):
         past_key_value=None,
         output_attentions=False,
         mode=None,
+        unpadded=None,
+        cross_key_value=None,
     ):
+        static_cache = isinstance(past_key_value, StaticLayerCache)
         # decoder uni-directional self-attention cached key/values tuple is at positions 1,2
-        self_attn_past_key_value = past_key_value[:2] if past_key_value is not None else None
+        if static_cache:
+            self_attn_past_key_value = past_key_value
+        else:
+            self_attn_past_key_value = past_key_value[:2] if past_key_value is not None else None
         self_attention_outputs = self.attention(
             hidden_states,
             attention_mask,
             head_mask,
             output_attentions=output_attentions,
             past_key_value=self_attn_past_key_value,
+            unpadded=unpadded,
         )
         attention_output = self_attention_outputs[0]
 
@@ -356,20 +521,37 @@ class BertLayer(nn.Module):
         present_key_value = self_attention_outputs[-1]
 
         if mode=='multimodal':
-            assert encoder_hidden_states is not None, "encoder_hidden_states must be given for cross-attention layers"
-
+            assert encoder_hidden_states is not None or cross_key_value is not None, \
+                "encoder_hidden_states or their keys/values must be given for cross-attention layers"
+
+            # cross-attention cached key/values tuple is at positions 3,4 of past_key_value tuple
+            if static_cache:
+                cross_attn_past_key_value = past_key_value.cross_key_value
+            elif cross_key_value is not None:
+                cross_attn_past_key_value = cross_key_value
+            else:
+                cross_attn_past_key_value = past_key_value[2:] if past_key_value is not None and len(past_key_value) == 4 else None
             cross_attention_outputs = self.crossattention(
                 attention_output,
                 attention_mask,
                 head_mask,
                 encoder_hidden_states,
                 encoder_attention_mask,
+                past_key_value=cross_attn_past_key_value,
                 output_attentions=output_attentions,
+                unpadded=unpadded,
             )
             attention_output = cross_attention_outputs[0]
-            outputs = outputs + cross_attention_outputs[1:-1]  # add cross attentions if we output attention weights                               
+            outputs = outputs + cross_attention_outputs[1:-1]  # add cross attentions if we output attention weights
+            present_key_value = present_key_value + cross_attention_outputs[-1]
+            if static_cache:
+                past_key_value.cross_key_value = cross_attention_outputs[-1]
+        if static_cache:
+            present_key_value = past_key_value
+        # packed hidden states are [tokens, width]
+        seq_len_dim = self.seq_len_dim if unpadded is None else 0
         layer_output = apply_chunking_to_forward(
-            self.feed_forward_chunk, self.chunk_size_feed_forward, self.seq_len_dim, attention_output
+            self.feed_forward_chunk, self.chunk_size_feed_forward, seq_len_dim, attention_output
         )
         outputs = (layer_output,) + outputs
 
@@ -403,6 +585,8 @@ class BertEncoder(nn.Module):
         output_hidden_states=False,
         return_dict=True,
         mode='multimodal',
+        unpadded=None,
+        encoder_key_values=None,
     ):
         all_hidden_states = () if output_hidden_states else None
         all_self_attentions = () if output_attentions else None
@@ -417,6 +601,7 @@ class BertEncoder(nn.Module):
 
             layer_head_mask = head_mask[i] if head_mask is not None else None
             past_key_value = past_key_values[i] if past_key_values is not None else None
+            cross_key_value = encoder_key_values[i] if encoder_key_values is not None else None
 
             if self.gradient_checkpointing and self.training:
 
@@ -428,7 +613,8 @@ class BertEncoder(nn.Module):
 
                 def create_custom_forward(module):
                     def custom_forward(*inputs):
-                        return module(*inputs, past_key_value, output_attentions)
+                        return module(*inputs, past_key_value, output_attentions, unpadded=unpadded,
+                                      cross_key_value=cross_key_value)
 
                     return custom_forward
 
@@ -451,6 +637,8 @@ class BertEncoder(nn.Module):
                     past_key_value,
                     output_attentions,
                     mode=mode,
+                    unpadded=unpadded,
+                    cross_key_value=cross_key_value,
                 )
 
             hidden_states = layer_outputs[0]
@@ -462,6 +650,10 @@ class BertEncoder(nn.Module):
         if output_hidden_states:
             all_hidden_states = all_hidden_states + (hidden_states,)
 
+        if use_cache and isinstance(past_key_values, StaticKVCache):
+            past_key_values.advance(hidden_states.size(1))
+            next_decoder_cache = past_key_values
+
         if not return_dict:
             return tuple(
                 v
@@ -587,6 +779,8 @@ class BertModel(BertPreTrainedModel):
         self.encoder = BertEncoder(config)
 
         self.pooler = BertPooler(config) if add_pooling_layer else None
+        # run the encoder on the non-padding tokens only (see UnpaddedBatch)
+        self.unpad_inputs = getattr(config, "unpad_inputs", False)
 
         self.init_weights()
  
@@ -605,6 +799,14 @@ class BertModel(BertPreTrainedModel):
         for layer, heads in heads_to_prune.items():
             self.encoder.layer[layer].attention.prune_heads(heads)
 
+    def cross_key_values(self, encoder_hidden_states):
+        """
+        Cross-attention keys and values of every layer for encoder_hidden_states [batch, length, width]. Passed to
+        forward() as encoder_key_values instead of the encoder states, they are not projected again, and one row
+        of them serves any number of consecutive text rows.
+        """
+        return tuple(layer.crossattention.self.encoder_key_value(encoder_hidden_states) for layer in self.encoder.layer)
+
     
     def get_extended_attention_mask(self, attention_mask: Tensor, input_shape: Tuple[int], device: device, is_decoder: bool) -> Tensor:
         """
@@ -684,6 +886,7 @@ class BertModel(BertPreTrainedModel):
         return_dict=None,
         is_decoder=False,
         mode='multimodal',
+        encoder_key_values=None,
     ):
         r"""
         encoder_hidden_states  (:obj:`torch.FloatTensor` of shape :obj:`(batch_size, sequence_length, hidden_size)`, `optional`):
@@ -702,6 +905,9 @@ class BertModel(BertPreTrainedModel):
         use_cache (:obj:`bool`, `optional`):
             If set to :obj:`True`, :obj:`past_key_values` key value states are returned and can be used to speed up
             decoding (see :obj:`past_key_values`).
+        encoder_key_values (:obj:`tuple(tuple(torch.FloatTensor))`, `optional`):
+            Output of :meth:`cross_key_values`, used in place of :obj:`encoder_hidden_states`. Its batch size may
+            divide the text batch size, each row then serving that many consecutive texts.
         """
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -732,7 +938,10 @@ class BertModel(BertPreTrainedModel):
             raise ValueError("You have to specify either input_ids or inputs_embeds or encoder_embeds")
 
         # past_key_values_length
-        past_key_values_length = past_key_values[0][0].shape[2] if past_key_values is not None else 0
+        if isinstance(past_key_values, StaticKVCache):
+            past_key_values_length = past_key_values.length
+        else:
+            past_key_values_length = past_key_values[0][0].shape[2] if past_key_values is not None else 0
 
         if attention_mask is None:
             attention_mask = torch.ones(((batch_size, seq_length + past_key_values_length)), device=device)
@@ -744,8 +953,10 @@ class BertModel(BertPreTrainedModel):
 
         # If a 2D or 3D attention mask is provided for the cross-attention
         # we need to make broadcastable to [batch_size, num_heads, seq_length, seq_length]
-        if encoder_hidden_states is not None:
-            if type(encoder_hidden_states) == list:
+        if encoder_hidden_states is not None or encoder_key_values is not None:
+            if encoder_key_values is not None:
+                encoder_batch_size, _, encoder_sequence_length, _ = encoder_key_values[0][0].size()
+            elif type(encoder_hidden_states) == list:
                 encoder_batch_size, encoder_sequence_length, _ = encoder_hidden_states[0].size()
             else:
                 encoder_batch_size, encoder_sequence_length, _ = encoder_hidden_states.size()
@@ -767,6 +978,16 @@ class BertModel(BertPreTrainedModel):
         # input head_mask has shape [num_heads] or [num_hidden_layers x num_heads]
         # and head_mask is converted to shape [num_hidden_layers x batch x num_heads x seq_length x seq_length]
         head_mask = self.get_head_mask(head_mask, self.config.num_hidden_layers)
+
+        # bidirectional encoding of padded input ids; outputs at the padding positions are zeros
+        unpadded = None
+        if (self.unpad_inputs and not is_decoder and input_ids is not None and attention_mask.dim() == 2
+                and past_key_values is None and not output_attentions and not output_hidden_states
+                and not attention_mask.all()):
+            unpadded = UnpaddedBatch(attention_mask)
+            if position_ids is None:
+                position_ids = self.embeddings.position_ids[:, :seq_length].expand(batch_size, -1)
+            input_ids, position_ids = unpadded.unpad(input_ids), unpadded.unpad(position_ids)
         
         if encoder_embeds is None:
             embedding_output = self.embeddings(
@@ -790,8 +1011,12 @@ class BertModel(BertPreTrainedModel):
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
             mode=mode,
+            unpadded=unpadded,
+            encoder_key_values=encoder_key_values,
         )
         sequence_output = encoder_outputs[0]
+        if unpadded is not None:
+            sequence_output = unpadded.pad(sequence_output)
         pooled_output = self.pooler(sequence_output) if self.pooler is not None else None
 
         if not return_dict:
@@ -818,6 +1043,8 @@ class BertLMHeadModel(BertPreTrainedModel):
 
         self.bert = BertModel(config, add_pooling_layer=False)
         self.cls = BertOnlyMLMHead(config)
+        # with labels, compute the LM loss this many positions at a time instead of materializing all logits
+        self.loss_chunk_size = getattr(config, "loss_chunk_size", 0)
 
         self.init_weights()
 
@@ -865,6 +1092,8 @@ class BertLMHeadModel(BertPreTrainedModel):
             If :obj:`past_key_values` are used, the user can optionally input only the last :obj:`decoder_input_ids`
             (those that don't have their past key value states given to this model) of shape :obj:`(batch_size, 1)`
             instead of all :obj:`decoder_input_ids` of shape :obj:`(batch_size, sequence_length)`.
+            In multimodal mode the last two tensors of each tuple are the cross-attention keys and values of
+            :obj:`encoder_hidden_states`, of shape :obj:`(batch_size, num_heads, encoder_sequence_length, embed_size_per_head)`.
         use_cache (:obj:`bool`, `optional`):
             If set to :obj:`True`, :obj:`past_key_values` key value states are returned and can be used to speed up
             decoding (see :obj:`past_key_values`).
@@ -901,13 +1130,18 @@ class BertLMHeadModel(BertPreTrainedModel):
         )
         
         sequence_output = outputs[0]
-        prediction_scores = self.cls(sequence_output)
+
+        chunked_loss = labels is not None and not return_logits and self.loss_chunk_size > 0
+        # with a chunked loss the logits are never materialized for the whole batch, so none are returned
+        prediction_scores = None if chunked_loss else self.cls(sequence_output)
         
         if return_logits:
             return prediction_scores[:, :-1, :].contiguous()  
 
         lm_loss = None
-        if labels is not None:
+        if chunked_loss:
+            lm_loss = self.chunked_lm_loss(sequence_output, labels, reduction)
+        elif labels is not None:
             # we are doing next-token prediction; shift prediction scores and input ids by one
             shifted_prediction_scores = prediction_scores[:, :-1, :].contiguous()
             labels = labels[:, 1:].contiguous()
@@ -929,14 +1163,47 @@ class BertLMHeadModel(BertPreTrainedModel):
             cross_attentions=outputs.cross_attentions,
         )
 
+    def lm_chunk_loss(self, hidden_states, labels):
+        prediction_scores = self.cls(hidden_states)
+        loss = F.cross_entropy(prediction_scores.reshape(-1, self.config.vocab_size), labels.reshape(-1),
+                               reduction='none', label_smoothing=0.1)
+        return loss.view(labels.size())
+
+    def chunked_lm_loss(self, sequence_output, labels, reduction='mean'):
+        """
+        Next-token loss of forward() computed over loss_chunk_size positions at a time. Each chunk's logits are freed
+        after its loss is taken and recomputed in backward, so at most one [batch, loss_chunk_size, vocab] logits
+        tensor is alive instead of [batch, length, vocab] plus its shifted copy.
+        """
+        hidden_states = sequence_output[:, :-1, :]
+        labels = labels[:, 1:]
+        losses = []
+        for start in range(0, hidden_states.size(1), self.loss_chunk_size):
+            chunk = hidden_states[:, start:start + self.loss_chunk_size]
+            chunk_labels = labels[:, start:start + self.loss_chunk_size]
+            if torch.is_grad_enabled() and chunk.requires_grad:
+                losses.append(torch.utils.checkpoint.checkpoint(self.lm_chunk_loss, chunk, chunk_labels))
+            else:
+                losses.append(self.lm_chunk_loss(chunk, chunk_labels))
+        # ignored positions have a loss of 0
+        lm_loss = torch.cat(losses, dim=1)
+        if reduction == 'none':
+            return lm_loss.sum(1)
+        return lm_loss.sum() / (labels != -100).sum()
+
     def prepare_inputs_for_generation(self, input_ids, past=None, attention_mask=None, **model_kwargs):
+        # newer transformers versions pass the cache as past_key_values
+        if past is None:
+            past = model_kwargs.get("past_key_values", None)
         input_shape = input_ids.shape
         # if model is used as a decoder in encoder-decoder model, the decoder attention mask is created on the fly
         if attention_mask is None:
             attention_mask = input_ids.new_ones(input_shape)
 
-        # cut decoder_input_ids if past is used
-        if past is not None:
+        # cut decoder_input_ids if past is used; a StaticKVCache can be passed in empty before the first step
+        if isinstance(past, StaticKVCache):
+            input_ids = input_ids[:, past.length:]
+        elif past is not None:
             input_ids = input_ids[:, -1:]
 
         return {
@@ -949,7 +1216,11 @@ class BertLMHeadModel(BertPreTrainedModel):
         }
 
     def _reorder_cache(self, past, beam_idx):
+        if isinstance(past, StaticKVCache):
+            return past.reorder(beam_idx)
+        # beams only move within their own image, and every beam of an image holds the same cross-attention
+        # keys/values, so those are left in place and only the self-attention cache is reordered
         reordered_past = ()
         for layer_past in past:
-            reordered_past += (tuple(past_state.index_select(0, beam_idx) for past_state in layer_past),)
+            reordered_past += (tuple(past_state.index_select(0, beam_idx) for past_state in layer_past[:2]) + layer_past[2:],)
         return reordered_past
@@ -1,3 +1,5 @@
+import math
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -38,6 +40,8 @@ class Attention(nn.Module):
         head_dim = dim // num_heads
         # NOTE scale factor was wrong in my original version, can set manually to be compat with prev weights
         self.scale = qk_scale or head_dim ** -0.5
+        # fused scaled_dot_product_attention whenever the attention map is not captured
+        self.fused_attn = hasattr(F, 'scaled_dot_product_attention')
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(dim, dim)
@@ -57,25 +61,82 @@ class Attention(nn.Module):
     def get_attention_map(self):
         return self.attention_map
     
-    def forward(self, x, register_hook=False):
+    def forward(self, x, register_hook=False, size=None, return_keys=False):
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]   # make torchscript happy (cannot use tensor as tuple)
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
-                
-        if register_hook:
-            self.save_attention_map(attn)
-            attn.register_hook(self.save_attn_gradients)        
+        # proportional attention: a merged token counts once for every patch it stands for
+        size_bias = size.log()[:, None, None, :, 0].to(q.dtype) if size is not None else None
+
+        if self.fused_attn and not register_hook:
+            # the kernel scales by head_dim ** -0.5 itself, so only a custom qk_scale needs folding into q
+            default_scale = (C // self.num_heads) ** -0.5
+            if self.scale != default_scale:
+                q = q * (self.scale / default_scale)
+            x = F.scaled_dot_product_attention(q, k, v, attn_mask=size_bias,
+                                               dropout_p=self.attn_drop.p if self.training else 0.)
+        else:
+            attn = (q @ k.transpose(-2, -1)) * self.scale
+            if size_bias is not None:
+                attn = attn + size_bias
+            attn = attn.softmax(dim=-1)
+            attn = self.attn_drop(attn)
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+            if register_hook:
+                self.save_attention_map(attn)
+                attn.register_hook(self.save_attn_gradients)
+            x = attn @ v
+
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
+        if return_keys:
+            return x, k.mean(1)
         return x
 
 
+def bipartite_soft_matching(metric, r):
+    """ Token merging (ToMe, Bolya et al. 2023)
+    Tokens are split alternately into two sets, and the r tokens of the first set that are most similar to some
+    token of the second set are merged into it. The CLS token is never merged away and stays first.
+    Args:
+        metric (Tensor): [batch, tokens, dim] features the similarity is measured on
+        r (int): number of tokens to remove, at most (tokens - 1) // 2
+    Returns:
+        a function that sums the merged rows of a [batch, tokens, channels] tensor into [batch, tokens - r, channels]
+    """
+    with torch.no_grad():
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = metric[:, ::2], metric[:, 1::2]
+        scores = a @ b.transpose(-1, -2)
+        scores[:, 0] = -math.inf
+
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unmerged_idx = edge_idx[:, r:].sort(dim=1)[0]
+        src_idx = edge_idx[:, :r]
+        dst_idx = node_idx[..., None].gather(dim=1, index=src_idx)
+
+    def merge(x):
+        src, dst = x[:, ::2], x[:, 1::2]
+        n, t, c = src.shape
+        unmerged = src.gather(dim=1, index=unmerged_idx.expand(n, t - r, c))
+        src = src.gather(dim=1, index=src_idx.expand(n, r, c))
+        dst = dst.scatter_add(1, dst_idx.expand(n, r, c), src)
+        return torch.cat([unmerged, dst], dim=1)
+
+    return merge
+
+
+def merge_tokens(x, size, metric, r):
+    # size-weighted average of merged tokens; size [batch, tokens, 1] counts the patches behind each token
+    merge = bipartite_soft_matching(metric, r)
+    x = merge(x * size)
+    size = merge(size)
+    return x / size, size
+
+
 class Block(nn.Module):
 
     def __init__(self, dim, num_heads, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop=0., attn_drop=0.,
@@ -99,6 +160,15 @@ class Block(nn.Module):
         x = x + self.drop_path(self.mlp(self.norm2(x)))
         return x
 
+    def forward_merging(self, x, size, r):
+        # merges r tokens between the attention and the MLP, on the attention keys
+        x_attn, keys = self.attn(self.norm1(x), size=size, return_keys=True)
+        x = x + self.drop_path(x_attn)
+        if r > 0:
+            x, size = merge_tokens(x, size, keys, r)
+        x = x + self.drop_path(self.mlp(self.norm2(x)))
+        return x, size
+
     
 class VisionTransformer(nn.Module):
     """ Vision Transformer
@@ -108,7 +178,7 @@ class VisionTransformer(nn.Module):
     def __init__(self, img_size=224, patch_size=16, in_chans=3, num_classes=1000, embed_dim=768, depth=12,
                  num_heads=12, mlp_ratio=4., qkv_bias=True, qk_scale=None, representation_size=None,
                  drop_rate=0., attn_drop_rate=0., drop_path_rate=0., norm_layer=None, 
-                 use_grad_checkpointing=False, ckpt_layer=0):
+                 use_grad_checkpointing=False, ckpt_layer=0, token_merge_ratio=0.):
         """
         Args:
             img_size (int, tuple): input image size
@@ -126,6 +196,7 @@ class VisionTransformer(nn.Module):
             attn_drop_rate (float): attention dropout rate
             drop_path_rate (float): stochastic depth rate
             norm_layer: (nn.Module): normalization layer
+            token_merge_ratio (float): fraction of the patch tokens each block merges away (ToMe), 0 to disable
         """
         super().__init__()
         self.num_features = self.embed_dim = embed_dim  # num_features for consistency with other models
@@ -149,6 +220,7 @@ class VisionTransformer(nn.Module):
             )
             for i in range(depth)])
         self.norm = norm_layer(embed_dim)
+        self.token_merge_ratio = token_merge_ratio
 
         trunc_normal_(self.pos_embed, std=.02)
         trunc_normal_(self.cls_token, std=.02)
@@ -167,7 +239,11 @@ class VisionTransformer(nn.Module):
     def no_weight_decay(self):
         return {'pos_embed', 'cls_token'}
 
-    def forward(self, x, register_blk=-1):
+    def merge_count(self, num_tokens):
+        # tokens the next block removes: a fraction of the patch tokens, at most half of them
+        return min(int(self.token_merge_ratio * (num_tokens - 1)), (num_tokens - 1) // 2)
+
+    def forward(self, x, register_blk=-1, return_atts=False):
         B = x.shape[0]
         x = self.patch_embed(x)
 
@@ -177,10 +253,19 @@ class VisionTransformer(nn.Module):
         x = x + self.pos_embed[:,:x.size(1),:]
         x = self.pos_drop(x)
 
-        for i,blk in enumerate(self.blocks):
-            x = blk(x, register_blk==i)
+        if self.token_merge_ratio > 0 and register_blk < 0:
+            # attention maps are only captured at full resolution
+            size = torch.ones_like(x[..., :1])
+            for blk in self.blocks:
+                x, size = blk.forward_merging(x, size, self.merge_count(x.size(1)))
+        else:
+            for i,blk in enumerate(self.blocks):
+                x = blk(x, register_blk==i)
         x = self.norm(x)
-        
+
+        if return_atts:
+            # every image keeps the same number of tokens, so the mask is all ones at the reduced length
+            return x, torch.ones(x.size()[:-1], dtype=torch.long, device=x.device)
         return x
 
     @torch.jit.ignore()
@@ -0,0 +1,169 @@
+import os
+import time
+
+import torch
+import torch.nn.functional as F
+
+from models.blip import itm_scores
+from retrieval.shards import open_shards
+from retrieval.similarity import streaming_top_k
+
+
+class RetrievalEngine:
+    """
+    Two-stage image-text retrieval with a BLIP_Retrieval (or BLIP_ITM) model.
+
+    Stage one ranks the whole gallery by ITC similarity of the 256-d normalized features and keeps the best
+    k_test items; stage two reranks those with the ITM head and returns ITM logit + ITC similarity, as BLIP's
+    retrieval evaluation does. Text-to-image reranking needs the images' ViT embeddings, which the engine keeps
+    in fp16 unless the gallery is added with keep_embeds=False (stage one only). Stage one streams over the
+    gallery in chunks of chunk_size, split over num_workers threads (see streaming_top_k).
+    """
+    def __init__(self, model, k_test=256, itm_batch_size=128, max_length=35, chunk_size=16384, num_workers=0):
+        self.model = model
+        self.device = next(model.parameters()).device
+        self.dtype = next(model.parameters()).dtype
+        self.k_test = k_test
+        self.itm_batch_size = itm_batch_size
+        self.max_length = max_length
+        self.chunk_size = chunk_size
+        self.num_workers = num_workers
+
+        self.image_feats = torch.empty(0, model.vision_proj.out_features, device=self.device)
+        self.image_embeds = None
+        self.text_feats = torch.empty(0, model.text_proj.out_features, device=self.device)
+        self.text_ids = torch.empty(0, max_length, dtype=torch.long, device=self.device)
+        self.text_atts = torch.empty(0, max_length, dtype=torch.long, device=self.device)
+
+    @torch.no_grad()
+    def encode_images(self, images):
+        # normalized ITC features [batch, embed_dim] and ViT embeddings [batch, tokens, width]
+        image_embeds = self.model.visual_encoder(images.to(self.device, self.dtype))
+        image_feats = F.normalize(self.model.vision_proj(image_embeds[:,0,:]), dim=-1)
+        return image_feats.float(), image_embeds
+
+    @torch.no_grad()
+    def encode_texts(self, texts):
+        # normalized ITC features [batch, embed_dim], and ITM input ids (starting with [ENC]) and attention mask
+        tokenizer = self.model.tokenizer
+        text = tokenizer(texts, padding='max_length', truncation=True, max_length=self.max_length,
+                         return_tensors="pt").to(self.device)
+        text_output = self.model.text_encoder(text.input_ids, attention_mask = text.attention_mask,
+                                              return_dict = True, mode = 'text')
+        text_feats = F.normalize(self.model.text_proj(text_output.last_hidden_state[:,0,:]), dim=-1)
+        text_ids = text.input_ids.clone()
+        text_ids[:,0] = tokenizer.enc_token_id
+        return text_feats.float(), text_ids, text.attention_mask
+
+    def add_images(self, images, keep_embeds=True):
+        image_feats, image_embeds = self.encode_images(images)
+        self.add_image_features(image_feats, image_embeds if keep_embeds else None)
+
+    def add_image_features(self, image_feats, image_embeds=None):
+        self.image_feats = torch.cat([self.image_feats, image_feats.to(self.device)])
+        if image_embeds is not None:
+            image_embeds = image_embeds.to(self.device, torch.float16)
+            self.image_embeds = image_embeds if self.image_embeds is None else torch.cat([self.image_embeds, image_embeds])
+
+    def add_texts(self, texts):
+        text_feats, text_ids, text_atts = self.encode_texts(texts)
+        self.add_text_features(text_feats, text_ids, text_atts)
+
+    def add_text_features(self, text_feats, text_ids, text_atts):
+        self.text_feats = torch.cat([self.text_feats, text_feats.to(self.device)])
+        self.text_ids = torch.cat([self.text_ids, text_ids.to(self.device)])
+        self.text_atts = torch.cat([self.text_atts, text_atts.to(self.device)])
+
+    def load_shards(self, directory):
+        """
+        Uses a gallery written by extract_features.py in place of the added one: its images/ and texts/ shards
+        stay memory-mapped, and only the rows a query touches are read. Such a gallery cannot be added to.
+        Returns:
+            the image ids and text ids, in gallery order
+        """
+        image_ids, images = open_shards(os.path.join(directory, 'images'))
+        text_ids, texts = open_shards(os.path.join(directory, 'texts'))
+        self.image_feats, self.image_embeds = images['image_feats'], images.get('image_embeds')
+        self.text_feats, self.text_ids, self.text_atts = texts['text_feats'], texts['text_ids'], texts['text_atts']
+        return image_ids, text_ids
+
+    def search_images(self, texts, k=10, rerank=True, timings=None):
+        """
+        Top-k gallery images for each text. Returns image indices and scores, both [len(texts), k].
+        If a timings dict is given, the seconds spent in encode, itc and itm are added to it.
+        """
+        start = time.perf_counter()
+        text_feats, text_ids, text_atts = self.encode_texts(texts)
+        add_time(timings, 'encode', start)
+        return self.rank_images(text_feats, text_ids, text_atts, k, rerank, timings)
+
+    def search_texts(self, images, k=10, rerank=True, timings=None):
+        """ Top-k gallery texts for each image, as search_images(). """
+        start = time.perf_counter()
+        image_feats, image_embeds = self.encode_images(images)
+        add_time(timings, 'encode', start)
+        return self.rank_texts(image_feats, image_embeds, k, rerank, timings)
+
+    def top_k(self, query_feats, gallery_feats, k):
+        # ITC similarities and gallery indices [queries, k], best first
+        return streaming_top_k(query_feats, gallery_feats, k, chunk_size=self.chunk_size,
+                               num_workers=self.num_workers)
+
+    @torch.no_grad()
+    def rank_images(self, text_feats, text_ids, text_atts, k=10, rerank=True, timings=None):
+        start = time.perf_counter()
+        k_test = max(k, self.k_test) if rerank else k
+        sims, candidates = self.top_k(text_feats.to(self.device), self.image_feats, k_test)
+        add_time(timings, 'itc', start)
+        if not rerank:
+            return candidates, sims
+        assert self.image_embeds is not None, "reranking images needs the gallery's image_embeds (keep_embeds=True)"
+
+        start = time.perf_counter()
+        scores = torch.empty_like(sims)
+        for i in range(candidates.size(0)):
+            # every candidate image has its own keys/values, so they only exist itm_batch_size images at a time;
+            # the query text is shared
+            for j in range(0, candidates.size(1), self.itm_batch_size):
+                batch = slice(j, j + self.itm_batch_size)
+                image_embeds = self.image_embeds[candidates[i, batch]].to(self.device, self.dtype)
+                logits = itm_scores(self.model.text_encoder, self.model.itm_head, text_ids[i:i+1].to(self.device),
+                                    text_atts[i:i+1].to(self.device), image_embeds=image_embeds,
+                                    batch_size=self.itm_batch_size)
+                scores[i, batch] = logits[:,1].float() + sims[i, batch]
+        add_time(timings, 'itm', start)
+        return rerank_top(candidates, scores, k)
+
+    @torch.no_grad()
+    def rank_texts(self, image_feats, image_embeds, k=10, rerank=True, timings=None):
+        start = time.perf_counter()
+        k_test = max(k, self.k_test) if rerank else k
+        sims, candidates = self.top_k(image_feats.to(self.device), self.text_feats, k_test)
+        add_time(timings, 'itc', start)
+        if not rerank:
+            return candidates, sims
+
+        start = time.perf_counter()
+        scores = torch.empty_like(sims)
+        for i in range(candidates.size(0)):
+            # one set of image keys/values shared by all candidate texts, which are read itm_batch_size at a time
+            image_key_values = self.model.text_encoder.cross_key_values(image_embeds[i:i+1].to(self.device, self.dtype))
+            for j in range(0, candidates.size(1), self.itm_batch_size):
+                batch = slice(j, j + self.itm_batch_size)
+                logits = itm_scores(self.model.text_encoder, self.model.itm_head,
+                                    self.text_ids[candidates[i, batch]].to(self.device),
+                                    self.text_atts[candidates[i, batch]].to(self.device), image_key_values,
+                                    batch_size=self.itm_batch_size)
+                scores[i, batch] = logits[:,1].float() + sims[i, batch]
+        add_time(timings, 'itm', start)
+        return rerank_top(candidates, scores, k)
+
+
+def rerank_top(candidates, scores, k):
+    scores, order = scores.topk(min(k, scores.size(1)), dim=1)
+    return candidates.gather(1, order), scores
+
+
+def add_time(timings, stage, start):
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.) + time.perf_counter() - start
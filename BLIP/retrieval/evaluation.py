@@ -0,0 +1,67 @@
+import torch
+
+from retrieval.similarity import streaming_top_k
+
+
+def recall_at_k(ranked, relevant, ks=(1, 5, 10)):
+    """
+    Recall@K from ranked result lists, as BLIP's retrieval evaluation computes it from the full similarity matrix:
+    a query counts as a hit at K if any of its relevant items is among its first K results. Items missing from a
+    list rank after it, so lists only need to be as long as the largest K.
+    Args:
+        ranked (LongTensor): [queries, length] retrieved item ids, best first
+        relevant (list): the relevant item ids of each query, one id or a list of ids
+    Returns:
+        dict of K -> recall in percent
+    """
+    ranks = first_relevant_rank(ranked, relevant)
+    return {k: 100.0 * (ranks < k).float().mean().item() for k in ks}
+
+
+def first_relevant_rank(ranked, relevant):
+    # [queries] position of the best ranked relevant item, ranked.size(1) if none was retrieved
+    num_queries, length = ranked.size()
+    targets = torch.full((num_queries, max(len(r) if isinstance(r, (list, tuple)) else 1 for r in relevant)), -1,
+                         dtype=torch.long)
+    for i, r in enumerate(relevant):
+        r = list(r) if isinstance(r, (list, tuple)) else [r]
+        targets[i, :len(r)] = torch.tensor(r)
+    hits = (ranked.cpu()[:, :, None] == targets[:, None, :]).any(dim=2)
+    ranks = torch.where(hits.any(dim=1), hits.float().argmax(dim=1), torch.full((num_queries,), length))
+    return ranks
+
+
+def dataset_ground_truth(dataset):
+    # relevant gallery items of a coco_karpathy_retrieval_eval / flickr30k_retrieval_eval split
+    text_to_image = [dataset.txt2img[i] for i in range(len(dataset.text))]
+    image_to_text = [dataset.img2txt[i] for i in range(len(dataset.image))]
+    return text_to_image, image_to_text
+
+
+def itc_eval(image_feats, text_feats, txt2img, img2txt, ks=(1, 5, 10), **top_k_args):
+    """
+    Image-text retrieval recall from ITC similarities alone, with the keys of BLIP's itm_eval (txt_r1 ... r_mean).
+    Only the top max(ks) items per query are kept, via streaming_top_k, instead of the full similarity matrix and
+    its argsort.
+    Args:
+        image_feats (Tensor, ndarray or ShardedArray): [images, embed_dim] normalized ITC features
+        text_feats (Tensor, ndarray or ShardedArray): [texts, embed_dim] normalized ITC features
+        txt2img (dict or list): image id of each text
+        img2txt (dict or list): text ids of each image
+        top_k_args: chunk_size, query_chunk_size, num_workers and backend of streaming_top_k
+    """
+    k = max(ks)
+    _, image_to_text = streaming_top_k(image_feats, text_feats, k, **top_k_args)
+    _, text_to_image = streaming_top_k(text_feats, image_feats, k, **top_k_args)
+    txt_r = recall_at_k(image_to_text, [img2txt[i] for i in range(len(image_feats))], ks)
+    img_r = recall_at_k(text_to_image, [txt2img[i] for i in range(len(text_feats))], ks)
+
+    result = {}
+    for k in ks:
+        result['txt_r%d' % k] = txt_r[k]
+    result['txt_r_mean'] = sum(txt_r.values()) / len(ks)
+    for k in ks:
+        result['img_r%d' % k] = img_r[k]
+    result['img_r_mean'] = sum(img_r.values()) / len(ks)
+    result['r_mean'] = (result['txt_r_mean'] + result['img_r_mean']) / 2
+    return result
@@ -0,0 +1,179 @@
+import warnings
+
+import numpy as np
+import torch
+
+from retrieval.similarity import streaming_top_k
+
+
+class ScalarQuantizer:
+    """
+    8-bit scalar quantization: every dimension is mapped linearly from its trained [min, max] range onto 256
+    levels, so a vector takes one byte per dimension, a quarter of float32.
+
+    Inner products are computed on the codes without decoding the gallery:
+    q . (codes * scale + low) = (q * scale) . codes + q . low.
+    """
+    def __init__(self):
+        self.low = self.scale = None
+
+    def train(self, vectors):
+        vectors = torch.as_tensor(vectors).float()
+        self.low = vectors.min(dim=0).values
+        self.scale = (vectors.max(dim=0).values - self.low).clamp(min=1e-12) / 255
+        return self
+
+    def encode(self, vectors):
+        vectors = torch.as_tensor(vectors).float()
+        return ((vectors - self.low) / self.scale).round().clamp(0, 255).to(torch.uint8)
+
+    def decode(self, codes):
+        return codes.float() * self.scale + self.low
+
+    def scores(self, queries, codes):
+        # [queries, codes] approximate inner products
+        return (queries * self.scale) @ codes.float().t() + (queries @ self.low)[:, None]
+
+    def code_size(self):
+        return self.low.numel()
+
+    def codebook_bytes(self):
+        return 2 * self.low.numel() * 4
+
+
+class ProductQuantizer:
+    """
+    Product quantization: vectors are split into num_subvectors equal slices and every slice is replaced by the
+    index of its nearest of num_centroids (256, one byte) k-means centroids, trained per slice. A 768-d vector
+    with 96 subvectors takes 96 bytes, 1/32 of float32.
+
+    Inner products with a query are looked up rather than computed (asymmetric distance computation): the
+    query's slices are scored once against every centroid, and each code sums num_subvectors table entries. The
+    lookups run as one sparse matmul of the codes, one-hot over [num_subvectors * num_centroids], with the table,
+    which is much faster than gathering the entries subvector by subvector.
+    """
+    def __init__(self, num_subvectors, num_centroids=256, iters=20, seed=0):
+        assert num_centroids <= 256, 'codes are stored in one byte per subvector'
+        self.num_subvectors = num_subvectors
+        self.requested_centroids = num_centroids
+        # centroids per subvector of the trained codebook, fewer than requested for a small training set
+        self.num_centroids = None
+        self.iters = iters
+        self.seed = seed
+        self.centroids = None
+
+    def train(self, vectors):
+        vectors = torch.as_tensor(vectors).float()
+        assert vectors.size(1) % self.num_subvectors == 0, \
+            'dimension %d is not divisible into %d subvectors' % (vectors.size(1), self.num_subvectors)
+        if vectors.size(0) == 0:
+            raise ValueError('no training vectors')
+        # a small gallery gets one centroid per training vector at most
+        self.num_centroids = min(self.requested_centroids, vectors.size(0))
+        if self.num_centroids < self.requested_centroids:
+            warnings.warn('%d training vectors, using %d centroids per subvector instead of %d'
+                          % (vectors.size(0), self.num_centroids, self.requested_centroids))
+        generator = torch.Generator().manual_seed(self.seed)
+        self.centroids = torch.stack([kmeans(part, self.num_centroids, self.iters, generator)
+                                      for part in self.split(vectors)])
+        return self
+
+    def split(self, vectors):
+        # [num_subvectors, vectors, sub_dim]
+        return vectors.reshape(vectors.size(0), self.num_subvectors, -1).transpose(0, 1)
+
+    def encode(self, vectors):
+        vectors = torch.as_tensor(vectors).float()
+        codes = [nearest(part, centroids) for part, centroids in zip(self.split(vectors), self.centroids)]
+        return torch.stack(codes, dim=1).to(torch.uint8)
+
+    def decode(self, codes):
+        parts = [centroids[codes[:, j].long()] for j, centroids in enumerate(self.centroids)]
+        return torch.cat(parts, dim=1)
+
+    def scores(self, queries, codes):
+        # [queries, codes] approximate inner products, from a [num_subvectors * num_centroids, queries] table
+        table = torch.einsum('jqd,jcd->jcq', self.split(queries.float()), self.centroids.to(queries.device))
+        columns = codes.long() + torch.arange(self.num_subvectors, device=codes.device) * self.num_centroids
+        rows = torch.arange(0, columns.numel() + 1, self.num_subvectors, device=codes.device)
+        with warnings.catch_warnings():
+            # sparse CSR support is flagged as beta
+            warnings.simplefilter('ignore')
+            one_hot = torch.sparse_csr_tensor(rows, columns.reshape(-1), table.new_ones(columns.numel()),
+                                              size=(codes.size(0), table.size(0) * table.size(1)),
+                                              check_invariants=False)
+        return (one_hot @ table.reshape(-1, table.size(2))).t()
+
+    def code_size(self):
+        return self.num_subvectors
+
+    def codebook_bytes(self):
+        return self.centroids.numel() * 4
+
+
+def kmeans(vectors, num_centroids, iters, generator):
+    # Lloyd's k-means from random training vectors; empty clusters are reseeded with random vectors
+    if vectors.size(0) < num_centroids:
+        raise ValueError('%d training vectors cannot seed %d centroids' % (vectors.size(0), num_centroids))
+    centroids = vectors[torch.randperm(vectors.size(0), generator=generator)[:num_centroids]].clone()
+    for _ in range(iters):
+        assignment = nearest(vectors, centroids)
+        counts = torch.bincount(assignment, minlength=num_centroids)
+        sums = torch.zeros_like(centroids).index_add_(0, assignment, vectors)
+        empty = counts == 0
+        centroids = sums / counts.clamp(min=1)[:, None]
+        if empty.any():
+            centroids[empty] = vectors[torch.randint(vectors.size(0), (int(empty.sum()),), generator=generator)]
+    return centroids
+
+
+def nearest(vectors, centroids, chunk_size=65536):
+    # index of the closest centroid (L2) of every vector
+    centroid_norms = (centroids ** 2).sum(dim=1)
+    return torch.cat([(centroid_norms - 2 * vectors[i:i + chunk_size] @ centroids.t()).argmin(dim=1)
+                      for i in range(0, vectors.size(0), chunk_size)])
+
+
+def compress(quantizer, vectors, chunk_size=65536):
+    """ Codes of all vectors (a tensor, array or ShardedArray), encoded chunk by chunk. """
+    return torch.cat([quantizer.encode(vectors[i:i + chunk_size]) for i in range(0, len(vectors), chunk_size)])
+
+
+def train_sample(vectors, num_train, seed=0):
+    # at most num_train random rows, in order, for training a quantizer
+    if len(vectors) <= num_train:
+        return gather_rows(vectors, torch.arange(len(vectors)))
+    index = torch.randperm(len(vectors), generator=torch.Generator().manual_seed(seed))[:num_train]
+    return gather_rows(vectors, index.sort().values)
+
+
+def compressed_search(quantizer, codes, queries, k, vectors=None, shortlist=100, **top_k_args):
+    """
+    Top-k search over quantized codes, rescored with the original vectors.
+
+    The codes are scanned with the quantizer's approximate inner products (streamed like streaming_top_k), the
+    best shortlist items are kept and, if vectors is given, scored again exactly with only those rows read.
+    Args:
+        codes (Tensor or ndarray): [gallery, code_size] uint8 codes from compress()
+        queries (Tensor): [queries, dim]
+        vectors (Tensor, ndarray or ShardedArray): [gallery, dim] original vectors, e.g. memory-mapped shards
+        top_k_args: chunk_size, query_chunk_size, num_workers and backend of streaming_top_k
+    Returns:
+        similarities and gallery indices, both [queries, k], best first; approximate without vectors
+    """
+    queries = torch.as_tensor(queries).float()
+    if vectors is None:
+        return streaming_top_k(queries, codes, k, score=quantizer.scores, **top_k_args)
+    _, candidates = streaming_top_k(queries, codes, max(k, shortlist), score=quantizer.scores, **top_k_args)
+    originals = gather_rows(vectors, candidates.reshape(-1)).float().reshape(*candidates.shape, -1)
+    sims = torch.bmm(originals, queries[:, :, None].to(originals.device)).squeeze(2)
+    sims, order = sims.topk(min(k, sims.size(1)), dim=1)
+    return sims, candidates.gather(1, order)
+
+
+def gather_rows(vectors, index):
+    if isinstance(vectors, np.ndarray):
+        return torch.from_numpy(np.ascontiguousarray(vectors[index.cpu().numpy()]))
+    if torch.is_tensor(vectors):
+        return vectors[index.to(vectors.device)]
+    return vectors[index]
@@ -0,0 +1,154 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+MANIFEST_NAME = 'manifest.json'
+
+
+class ShardWriter:
+    """
+    Appends rows of fixed-shape arrays to a directory of fixed-size .npy shards.
+
+    Every field (e.g. image_feats [256] float32 and image_embeds [577, 768] float16) gets one file per shard of
+    shard_size rows, preallocated and written in place through a memory map, plus an ids file naming the item of
+    each row. manifest.json lists the fields and how many rows of each shard are complete; it is rewritten after
+    every write(), once the rows are flushed, so a killed job loses at most the batch in flight and a new
+    ShardWriter on the same directory resumes after the last complete row.
+    """
+    def __init__(self, directory, fields, shard_size=4096):
+        """
+        Args:
+            fields (dict): field name -> (row shape, numpy dtype name)
+        """
+        self.directory = directory
+        manifest_path = os.path.join(directory, MANIFEST_NAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+            fields = {name: [list(shape), np.dtype(dtype).name] for name, (shape, dtype) in fields.items()}
+            if self.manifest['fields'] != fields or self.manifest['shard_size'] != shard_size:
+                raise ValueError('%s holds shards of %s, %d rows each' % (
+                    directory, self.manifest['fields'], self.manifest['shard_size']))
+        else:
+            os.makedirs(directory, exist_ok=True)
+            self.manifest = {'shard_size': shard_size, 'shards': [],
+                             'fields': {name: [list(shape), np.dtype(dtype).name]
+                                        for name, (shape, dtype) in fields.items()}}
+        self.ids = []
+        for shard in range(len(self.manifest['shards'])):
+            self.ids += read_ids(directory, shard, self.manifest['shards'][shard])
+        self.arrays = None
+
+    def __len__(self):
+        return sum(self.manifest['shards'])
+
+    def write(self, ids, **arrays):
+        """ Appends one row per id; arrays holds a [len(ids), *shape] array or tensor for every field. """
+        ids = list(ids)
+        assert set(arrays) == set(self.manifest['fields']), 'expected arrays for %s' % list(self.manifest['fields'])
+        arrays = {name: array.cpu().numpy() if torch.is_tensor(array) else np.asarray(array)
+                  for name, array in arrays.items()}
+        start = 0
+        while start < len(ids):
+            shards = self.manifest['shards']
+            if not shards or shards[-1] == self.manifest['shard_size']:
+                shards.append(0)
+                self.arrays = None
+            shard, count = len(shards) - 1, shards[-1]
+            if self.arrays is None:
+                self.arrays = self.open_shard(shard)
+            end = min(len(ids), start + self.manifest['shard_size'] - count)
+            for name, array in self.arrays.items():
+                array[count:count + end - start] = arrays[name][start:end]
+                array.flush()
+            shard_ids = self.ids[len(self) - count:] + ids[start:end]
+            write_json(os.path.join(self.directory, 'ids_%05d.json' % shard), shard_ids)
+            self.ids += ids[start:end]
+            shards[-1] = count + end - start
+            write_json(os.path.join(self.directory, MANIFEST_NAME), self.manifest)
+            start = end
+
+    def open_shard(self, shard):
+        arrays = {}
+        for name, (shape, dtype) in self.manifest['fields'].items():
+            path = shard_path(self.directory, name, shard)
+            if os.path.exists(path):
+                arrays[name] = np.load(path, mmap_mode='r+')
+            else:
+                arrays[name] = np.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+                                                         shape=(self.manifest['shard_size'], *shape))
+        return arrays
+
+
+class ShardedArray:
+    """
+    The rows of one field across its memory-mapped shards, indexed like a tensor of shape [rows, *shape].
+
+    Slices within a shard are zero-copy views of the mapped file; slices across shard boundaries and index
+    tensors gather their rows into a new tensor. The maps are copy-on-write, so the tensors can be written to
+    without touching the files.
+    """
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.offsets = np.cumsum([0] + [len(array) for array in arrays])
+        self.shape = (int(self.offsets[-1]),) + tuple(arrays[0].shape[1:])
+        self.dtype = torch.from_numpy(arrays[0][:0]).dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            assert step == 1, 'ShardedArray slices must be contiguous'
+            parts = [array[max(start - offset, 0):stop - offset]
+                     for array, offset in zip(self.arrays, self.offsets) if offset < stop and offset + len(array) > start]
+            if not parts:
+                return torch.from_numpy(self.arrays[0][:0])
+            return torch.from_numpy(parts[0] if len(parts) == 1 else np.concatenate(parts))
+        if isinstance(index, int):
+            return self[index:index + 1][0] if index >= 0 else self[len(self) + index]
+        index = torch.as_tensor(index).cpu().reshape(-1).numpy()
+        shards = np.searchsorted(self.offsets, index, side='right') - 1
+        rows = np.empty((len(index),) + self.shape[1:], dtype=self.arrays[0].dtype)
+        for shard in np.unique(shards):
+            mask = shards == shard
+            rows[mask] = self.arrays[shard][index[mask] - self.offsets[shard]]
+        return torch.from_numpy(rows)
+
+
+def open_shards(directory):
+    """
+    Opens a ShardWriter directory with no reading or copying beyond the manifest and ids.
+    Returns:
+        the item ids, in row order, and a dict of field name -> ShardedArray
+    """
+    with open(os.path.join(directory, MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+    ids, fields = [], {}
+    for shard, count in enumerate(manifest['shards']):
+        ids += read_ids(directory, shard, count)
+    for name, (shape, dtype) in manifest['fields'].items():
+        arrays = [np.load(shard_path(directory, name, shard), mmap_mode='c')[:count]
+                  for shard, count in enumerate(manifest['shards']) if count]
+        fields[name] = ShardedArray(arrays or [np.empty((0, *shape), dtype=dtype)])
+    return ids, fields
+
+
+def shard_path(directory, name, shard):
+    return os.path.join(directory, '%s_%05d.npy' % (name, shard))
+
+
+def read_ids(directory, shard, count):
+    # the ids file can run ahead of the manifest if a write was interrupted
+    with open(os.path.join(directory, 'ids_%05d.json' % shard)) as f:
+        return json.load(f)[:count]
+
+
+def write_json(path, obj):
+    # write then rename, so that readers and resumed jobs never see a partial file
+    with open(path + '.tmp', 'w') as f:
+        json.dump(obj, f)
+    os.replace(path + '.tmp', path)
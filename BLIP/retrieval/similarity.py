@@ -0,0 +1,81 @@
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import torch
+
+
+def streaming_top_k(query_feats, gallery_feats, k, chunk_size=16384, query_chunk_size=1024, num_workers=0,
+                    backend='thread', score=None):
+    """
+    Top-k gallery items per query by dot-product similarity, without building the [queries, gallery] matrix.
+
+    The gallery is read in chunks of chunk_size rows and every chunk's [query_chunk_size, chunk_size] similarity
+    block is folded into a running top-k, so memory stays at one block per worker whatever the gallery size. With
+    num_workers > 0 the gallery is split into that many contiguous ranges, each streamed by its own thread or
+    process, and their top-k lists are merged.
+    Args:
+        query_feats (Tensor, ndarray or ShardedArray): [queries, dim]
+        gallery_feats (Tensor, ndarray or ShardedArray): [gallery, dim]; only sliced, never copied whole
+        k (int): number of items to keep per query
+        score (callable): score(queries, chunk) -> [queries, chunk] similarities, for galleries that are not plain
+            features (e.g. quantized codes); the default is the dot product
+        backend (str): 'thread' or 'process'. Processes get the features through shared memory, so memory-mapped
+            features are copied there once.
+    Returns:
+        similarities and gallery indices, both [queries, min(k, gallery)], best first
+    """
+    num_items = len(gallery_feats)
+    if not num_items:
+        return torch.empty(len(query_feats), 0), torch.empty(len(query_feats), 0, dtype=torch.long)
+    if not num_workers:
+        return stream_range(query_feats, gallery_feats, k, 0, num_items, chunk_size, query_chunk_size, score)
+
+    bounds = [num_items * i // num_workers for i in range(num_workers + 1)]
+    if backend == 'process':
+        gallery_feats = torch.as_tensor(gallery_feats[:]).share_memory_()
+        query_feats = torch.as_tensor(query_feats[:]).cpu().share_memory_()
+        executor = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('spawn'))
+    else:
+        executor = ThreadPoolExecutor(num_workers)
+    with executor:
+        parts = [executor.submit(stream_range, query_feats, gallery_feats, k, start, end, chunk_size,
+                                 query_chunk_size, score)
+                 for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+        parts = [part.result() for part in parts]
+
+    values, indices = parts[0]
+    for part_values, part_indices in parts[1:]:
+        values, indices = merge_top_k(values, indices, part_values.to(values.device), part_indices.to(values.device), k)
+    return values, indices
+
+
+def stream_range(query_feats, gallery_feats, k, start, end, chunk_size, query_chunk_size, score=None):
+    # running top-k of the queries over gallery rows [start, end)
+    k = min(k, end - start)
+    values, indices = [], []
+    for q in range(0, len(query_feats), query_chunk_size):
+        queries = torch.as_tensor(query_feats[q:q + query_chunk_size])
+        top_values = top_indices = None
+        for c in range(start, end, chunk_size):
+            chunk = gallery_feats[c:min(c + chunk_size, end)]
+            # read-only arrays are copied one chunk at a time, torch cannot wrap them
+            if not torch.is_tensor(chunk):
+                chunk = torch.from_numpy(chunk) if chunk.flags.writeable else torch.tensor(chunk)
+            if score is None:
+                sims = queries @ chunk.to(queries.device, queries.dtype).t()
+            else:
+                sims = score(queries, chunk.to(queries.device))
+            chunk_values, chunk_indices = sims.topk(min(k, chunk.size(0)), dim=1)
+            chunk_indices += c
+            if top_values is None:
+                top_values, top_indices = chunk_values, chunk_indices
+            else:
+                top_values, top_indices = merge_top_k(top_values, top_indices, chunk_values, chunk_indices, k)
+        values.append(top_values)
+        indices.append(top_indices)
+    return torch.cat(values), torch.cat(indices)
+
+
+def merge_top_k(values, indices, new_values, new_indices, k):
+    values, order = torch.cat([values, new_values], dim=1).topk(min(k, values.size(1) + new_values.size(1)), dim=1)
+    return values, torch.cat([indices, new_indices], dim=1).gather(1, order)
@@ -0,0 +1,116 @@
+import queue
+import threading
+import time
+from concurrent import futures
+
+
+class QueueFull(Exception):
+    pass
+
+
+class RequestTimeout(Exception):
+    pass
+
+
+def collect_batch(q, max_batch_size, max_wait):
+    """
+    Blocks for the first item of q, then keeps taking items until max_batch_size are gathered
+    or max_wait seconds have passed since the first one arrived.
+    """
+    batch = [q.get()]
+    deadline = time.perf_counter() + max_wait
+    while len(batch) < max_batch_size:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(q.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+
+class MicroBatcher:
+    """
+    Dynamic micro-batching in front of a batched model call.
+
+    Request threads call submit() with a single item and block until its result is ready.
+    A background worker takes the first waiting item, keeps collecting more until either
+    max_batch_size items are gathered or max_wait_ms has passed since that first item,
+    then calls batch_fn(items) once and hands each result back to its caller.
+    A caller that passes a meta dict gets queue_wait (seconds) and batch_size filled in.
+    """
+    def __init__(self, batch_fn, max_batch_size=8, max_wait_ms=10, max_queue_size=256, timeout=60.0, name='batcher'):
+        """
+        Args:
+            batch_fn (callable): takes a list of items, returns a list of results in the same order
+            max_batch_size (int): largest batch handed to batch_fn
+            max_wait_ms (float): longest time the first item of a batch waits for company
+            max_queue_size (int): pending items beyond this are rejected with QueueFull
+            timeout (float): seconds a caller waits for its result before giving up
+        """
+        assert max_batch_size >= 1, "max_batch_size must be at least 1"
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.timeout = timeout
+        self.queue = queue.Queue(maxsize=max_queue_size)
+
+        self.worker = threading.Thread(target=self._loop, name=name, daemon=True)
+        self.worker.start()
+
+    def submit(self, item, meta=None):
+        future = futures.Future()
+        try:
+            self.queue.put_nowait((item, future, time.perf_counter(), meta))
+        except queue.Full:
+            raise QueueFull('%d requests already waiting' % self.queue.maxsize)
+        try:
+            return future.result(timeout=self.timeout)
+        except futures.TimeoutError:
+            future.cancel()
+            raise RequestTimeout('no result after %.1fs' % self.timeout)
+
+    def _loop(self):
+        while True:
+            batch = collect_batch(self.queue, self.max_batch_size, self.max_wait)
+            # callers that already timed out are dropped instead of being computed for nobody
+            batch = [entry for entry in batch if entry[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            started = time.perf_counter()
+            for _, _, enqueued, meta in batch:
+                if meta is not None:
+                    meta.update(queue_wait=started - enqueued, batch_size=len(batch))
+            try:
+                results = self.batch_fn([item for item, _, _, _ in batch])
+            except Exception as e:
+                for _, future, _, _ in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future, _, _), result in zip(batch, results):
+                future.set_result(result)
+
+
+def token_budget_batches(lengths, max_batch_tokens, max_batch_size=None):
+    """
+    Groups item indices into batches of similar length so little compute is spent on padding.
+    Items are sorted by length and a batch is closed once (batch size * longest length) would
+    exceed max_batch_tokens, which bounds the padded tensor each batch produces, or once it holds
+    max_batch_size items, which bounds the batch of many short items.
+    Returns a list of index lists; an item longer than max_batch_tokens still gets its own batch.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches = []
+    batch = []
+    for i in order:
+        # sorted ascending, so the newcomer is the longest item of the batch
+        full = max_batch_size is not None and len(batch) >= max_batch_size
+        if batch and (full or (len(batch) + 1) * lengths[i] > max_batch_tokens):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
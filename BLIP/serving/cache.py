@@ -0,0 +1,168 @@
+import hashlib
+import os
+import tempfile
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import torch
+
+
+def content_key(namespace, payload):
+    """
+    Content address of a payload: sha256 over the namespace (model identity and settings) and the raw bytes.
+    """
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    h = hashlib.sha256(namespace.encode('utf-8'))
+    h.update(b'\0')
+    h.update(payload)
+    return h.hexdigest()
+
+
+def normalize_text(text):
+    # whitespace and unicode composition do not change the tokens BERT sees
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+
+def _sizeof(value):
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_sizeof(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_sizeof(v) for v in value)
+    return 8
+
+
+class ResultCache:
+    """
+    Two-tier cache for model outputs keyed by content_key().
+
+    The memory tier is an LRU bounded by the total size of the cached values. The optional disk tier keeps
+    one torch.save file per key under cache_dir, survives restarts and refills the memory tier on a hit. It is
+    an LRU as well, bounded by max_disk_bytes of files: the index is rebuilt from the files' mtimes at startup,
+    hits touch their file, and puts delete the least recently used files beyond the limit.
+    """
+    def __init__(self, max_bytes=256 * 2**20, cache_dir=None, max_disk_bytes=4 * 2**30):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.disk_entries = OrderedDict()
+        self.disk_nbytes = 0
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'disk_evictions': 0}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._disk_scan()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[0]
+
+        value = self._disk_get(key)
+        with self.lock:
+            if value is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['disk_hits'] += 1
+            self._insert(key, value)
+            if key in self.disk_entries:
+                self.disk_entries.move_to_end(key)
+        try:
+            os.utime(self._path(key))
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            self._insert(key, value)
+        self._disk_put(key, value)
+
+    def info(self):
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries), bytes=self.nbytes, max_bytes=self.max_bytes,
+                        disk=bool(self.cache_dir), disk_entries=len(self.disk_entries), disk_bytes=self.disk_nbytes,
+                        max_disk_bytes=self.max_disk_bytes)
+
+    def _insert(self, key, value):
+        size = _sizeof(value)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[1]
+        self.entries[key] = (value, size)
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.nbytes -= evicted
+            self.stats['evictions'] += 1
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.pt')
+
+    def _disk_scan(self):
+        # least recently used first, by mtime; leftover .tmp files of interrupted writes are not entries
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_dir():
+                files += [(f.stat().st_mtime, f.name[:-3], f.stat().st_size)
+                          for f in os.scandir(entry.path) if f.name.endswith('.pt')]
+        for _, key, size in sorted(files):
+            self.disk_entries[key] = size
+            self.disk_nbytes += size
+        self._disk_prune()
+
+    def _disk_prune(self):
+        # drops least recently used files until the disk tier fits max_disk_bytes
+        while self.disk_nbytes > self.max_disk_bytes and self.disk_entries:
+            key, size = self.disk_entries.popitem(last=False)
+            self.disk_nbytes -= size
+            self.stats['disk_evictions'] += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                # already gone, e.g. pruned by another process sharing the directory
+                pass
+
+    def _disk_get(self, key):
+        if not self.cache_dir:
+            return None
+        try:
+            return torch.load(self._path(key), map_location='cpu')
+        except Exception:
+            # a missing, truncated or unreadable file is a miss; the next put overwrites it
+            return None
+
+    def _disk_put(self, key, value):
+        if not self.cache_dir:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so concurrent readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                torch.save(value, f)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        size = os.path.getsize(path)
+        with self.lock:
+            if key in self.disk_entries:
+                self.disk_nbytes -= self.disk_entries.pop(key)
+            self.disk_entries[key] = size
+            self.disk_nbytes += size
+            self._disk_prune()
@@ -0,0 +1,66 @@
+import base64
+import io
+from urllib.parse import quote
+
+import numpy as np
+import torch
+
+# response formats for embeddings: JSON lists (default), base64-packed arrays inside JSON,
+# a raw little-endian body, or a NumPy .npy body
+FORMATS = ('json', 'base64', 'raw', 'npy')
+MIMETYPES = {
+    'application/json': 'json',
+    'application/x-npy': 'npy',
+    'application/octet-stream': 'raw',
+}
+DTYPES = {'float32': '<f4', 'float16': '<f2'}
+
+
+class FormatError(ValueError):
+    pass
+
+
+def check_format(fmt, dtype):
+    if fmt not in FORMATS:
+        raise FormatError('format must be one of %s' % ', '.join(FORMATS))
+    if dtype not in DTYPES:
+        raise FormatError('dtype must be one of %s' % ', '.join(DTYPES))
+    return fmt, dtype
+
+
+def to_numpy(embeddings, dtype='float32'):
+    if isinstance(embeddings, torch.Tensor):
+        embeddings = embeddings.detach().cpu().float().numpy()
+    # explicit byte order so the bytes mean the same thing on every client
+    return np.ascontiguousarray(embeddings, dtype=DTYPES[dtype])
+
+
+def pack_base64(embeddings, dtype='float32'):
+    array = to_numpy(embeddings, dtype)
+    return {
+        'data': base64.b64encode(array.tobytes()).decode('ascii'),
+        'dtype': dtype,
+        'shape': list(array.shape),
+    }
+
+
+def encode_binary(embeddings, fmt, dtype='float32', fields=None):
+    """
+    Encodes embeddings as a raw or .npy body.
+    Returns (body, content_type, headers); other scalar fields travel as percent-encoded X-<Field> headers.
+    """
+    array = to_numpy(embeddings, dtype)
+    headers = {
+        'X-Embedding-Dtype': dtype,
+        'X-Embedding-Shape': ','.join(str(s) for s in array.shape),
+    }
+    for name, value in (fields or {}).items():
+        headers['X-' + name.capitalize()] = quote(str(value))
+
+    if fmt == 'raw':
+        return array.tobytes(), 'application/octet-stream', headers
+    elif fmt == 'npy':
+        buffer = io.BytesIO()
+        np.save(buffer, array, allow_pickle=False)
+        return buffer.getvalue(), 'application/x-npy', headers
+    raise FormatError('%s is not a binary format' % fmt)
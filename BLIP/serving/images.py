@@ -0,0 +1,58 @@
+import io
+
+import numpy as np
+import torch
+from PIL import Image
+
+# shrink by whole factors only while the image stays at least this many times the target size, so the
+# final bicubic resize still sees enough pixels to match resizing from full resolution
+REDUCING_GAP = 2.0
+
+
+def decode_image(image_bytes, target_size=None, reducing_gap=REDUCING_GAP):
+    """
+    Decodes an upload to an RGB PIL image. Given target_size (height, width), large images are decoded close to it:
+    JPEGs are DCT-scaled by 1/2, 1/4 or 1/8 while decoding, other formats are box-reduced by an integer factor
+    right after decoding, before the RGB conversion.
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    if target_size is None:
+        return image.convert('RGB')
+
+    height, width = target_size
+    min_width, min_height = int(width * reducing_gap), int(height * reducing_gap)
+    if image.format == 'JPEG':
+        # picks the largest scale that keeps both sides at or above the requested size
+        image.draft('RGB', (min_width, min_height))
+    factor = min(image.width // min_width, image.height // min_height)
+    if factor > 1:
+        if image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            image = image.convert('RGB')
+        image = image.reduce(factor)
+    return image.convert('RGB')
+
+
+class ImagePreprocessor:
+    """
+    Resize and normalize of a BlipImageProcessor, written into one uint8 batch tensor that is converted to
+    normalized floats in place instead of going through a float numpy array per image.
+    """
+    def __init__(self, image_processor):
+        self.size = (image_processor.size['height'], image_processor.size['width'])
+        self.resample = image_processor.resample
+        self.scale = image_processor.rescale_factor
+        self.mean = torch.tensor(image_processor.image_mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(image_processor.image_std).view(1, 3, 1, 1)
+
+    def __call__(self, images, dtype=torch.float32):
+        height, width = self.size
+        pixels = torch.empty(len(images), height, width, 3, dtype=torch.uint8)
+        for i, image in enumerate(images):
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            image = image.resize((width, height), resample=self.resample)
+            pixels[i].numpy()[...] = np.asarray(image)
+
+        pixel_values = pixels.permute(0, 3, 1, 2).to(torch.float32, memory_format=torch.contiguous_format)
+        pixel_values.mul_(self.scale).sub_(self.mean).div_(self.std)
+        return pixel_values.to(dtype)
@@ -0,0 +1,157 @@
+import bisect
+import json
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# latency buckets in seconds, from a cache hit up to a slow beam search on a large batch
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30.)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+
+def _format_labels(labelnames, labels, extra=()):
+    pairs = list(zip(labelnames, labels)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+
+
+class Histogram:
+    """ Cumulative Prometheus histogram; observe() is a bisect and three additions under a lock. """
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0., 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self.lock:
+            series = {labels: ([*counts], total, n) for labels, (counts, total, n) in self.series.items()}
+        for labels, (counts, total, n) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (self.name, _format_labels(self.labelnames, labels, [('le', bound)]),
+                                                 cumulative))
+            lines.append('%s_sum%s %.6f' % (self.name, _format_labels(self.labelnames, labels), total))
+            lines.append('%s_count%s %d' % (self.name, _format_labels(self.labelnames, labels), n))
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, value=1):
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        with self.lock:
+            series = dict(self.series)
+        for labels, value in sorted(series.items()):
+            lines.append('%s%s %s' % (self.name, _format_labels(self.labelnames, labels), value))
+        return lines
+
+
+class Gauge:
+    """
+    Value read from a callback at scrape time; fn returns a number, or a dict of label tuple -> number.
+    kind='counter' exposes a monotonic count kept elsewhere, such as the cache statistics.
+    """
+    def __init__(self, name, help, fn, labelnames=(), kind='gauge'):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            if value is not None:
+                lines.append('%s%s %s' % (self.name, _format_labels(self.labelnames, labels), value))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+class RequestTrace:
+    """
+    Stage timings of one request. Stages timed elsewhere (e.g. inside a batch or a worker process)
+    are added with record().
+    """
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.fields = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.) + time.perf_counter() - start
+
+    def record(self, **stages):
+        for name, seconds in stages.items():
+            if seconds is not None:
+                self.stages[name] = seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+
+class TraceLog:
+    """ Writes a sampled fraction of request traces as JSON lines to a file, or stderr. """
+    def __init__(self, sample_rate=0., path=None):
+        self.sample_rate = sample_rate
+        self.file = open(path, 'a', buffering=1) if path else sys.stderr
+        self.lock = threading.Lock()
+
+    def maybe_log(self, trace, status, total):
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return
+        record = dict(trace.fields, endpoint=trace.endpoint, status=status, total=round(total, 6),
+                      stages={name: round(seconds, 6) for name, seconds in trace.stages.items()},
+                      time=time.time())
+        with self.lock:
+            self.file.write(json.dumps(record) + '\n')
@@ -0,0 +1,68 @@
+import time
+
+import torch
+import torch.nn.functional as F
+
+from serving.batcher import token_budget_batches
+
+
+def generate_captions(model, image_embeds, **generate_kwargs):
+    # same as BlipForConditionalGeneration.generate, minus its own vision_model pass
+    text_config = model.config.text_config
+    image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long, device=image_embeds.device)
+    input_ids = torch.full((image_embeds.size(0), 1), text_config.bos_token_id, dtype=torch.long, device=image_embeds.device)
+    return model.text_decoder.generate(input_ids=input_ids,
+                                       eos_token_id=text_config.sep_token_id,
+                                       pad_token_id=text_config.pad_token_id,
+                                       encoder_hidden_states=image_embeds,
+                                       encoder_attention_mask=image_atts,
+                                       **generate_kwargs)
+
+
+@torch.no_grad()
+def analyze_images(model, processor, images, dtype=torch.float32, timings=None, image_preprocessor=None):
+    """
+    Captions a batch of PIL images with a BlipForConditionalGeneration.
+    Returns the captions and the float32 ViT CLS embeddings [batch, hidden] on the CPU.
+    If a timings dict is given, the seconds spent in preprocess, vision and generate are stored in it.
+    image_preprocessor (a serving.images.ImagePreprocessor) replaces the processor's own resize and normalize.
+    """
+    device = next(model.parameters()).device
+    start = time.perf_counter()
+    if image_preprocessor is not None:
+        pixel_values = image_preprocessor(images).to(device=device, dtype=dtype)
+    else:
+        pixel_values = processor(images, return_tensors="pt").pixel_values.to(device=device, dtype=dtype)
+    preprocessed = time.perf_counter()
+
+    # one ViT pass feeds both the caption decoder and the CLS embedding
+    image_embeds = model.vision_model(pixel_values=pixel_values).last_hidden_state
+    cls_embeddings = image_embeds[:, 0, :].float().cpu()
+    encoded = time.perf_counter()
+
+    out = generate_captions(model, image_embeds)
+    captions = processor.batch_decode(out, skip_special_tokens=True)
+    if timings is not None:
+        timings.update(preprocess=preprocessed - start, vision=encoded - preprocessed,
+                       generate=time.perf_counter() - encoded)
+    return captions, cls_embeddings
+
+
+@torch.no_grad()
+def encode_texts(encoder, tokenizer, texts, max_batch_tokens, max_length=512, max_batch_size=None):
+    """
+    L2-normalized CLS embeddings [len(texts), hidden] from a BERT-style encoder such as BGE, in input order.
+    Texts are tokenized once, sorted by length and run in batches of at most max_batch_tokens padded tokens
+    and at most max_batch_size texts.
+    """
+    device = next(encoder.parameters()).device
+    input_ids = tokenizer(texts, truncation=True, max_length=max_length)["input_ids"]
+    lengths = [len(ids) for ids in input_ids]
+
+    embeddings = torch.empty(len(texts), encoder.config.hidden_size)
+    for batch in token_budget_batches(lengths, max_batch_tokens, max_batch_size):
+        inputs = tokenizer.pad({"input_ids": [input_ids[i] for i in batch]}, return_tensors="pt").to(device)
+        last_hidden_state = encoder(**inputs, return_dict=True).last_hidden_state
+        # BGE is trained with CLS pooling
+        embeddings[batch] = F.normalize(last_hidden_state[:, 0].float(), p=2, dim=-1).cpu()
+    return embeddings
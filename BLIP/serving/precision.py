@@ -0,0 +1,36 @@
+import torch
+from torch import nn
+
+# CPU serving profiles: fp32 as trained, bf16 weights and activations, or dynamic int8 Linear layers
+PROFILES = ('fp32', 'bf16', 'int8')
+
+
+def apply_profile(model, profile):
+    """
+    Converts a model in place to a serving profile and returns it.
+    int8 quantizes the weights of every nn.Linear and quantizes activations on the fly; embeddings,
+    LayerNorms and attention matmuls stay in fp32.
+    """
+    if profile == 'fp32':
+        return model
+    elif profile == 'bf16':
+        return model.to(torch.bfloat16)
+    elif profile == 'int8':
+        return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    raise ValueError('profile must be one of %s' % ', '.join(PROFILES))
+
+
+def compute_dtype(profile):
+    # dtype of the tensors fed to a model converted with apply_profile
+    return torch.bfloat16 if profile == 'bf16' else torch.float32
+
+
+def model_bytes(model):
+    # resident size of the weights, counting packed int8 Linear weights
+    def nbytes(value):
+        if isinstance(value, torch.Tensor):
+            return value.numel() * value.element_size()
+        if isinstance(value, (tuple, list)):
+            return sum(nbytes(v) for v in value)
+        return 0
+    return sum(nbytes(value) for value in model.state_dict().values())
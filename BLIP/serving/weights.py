@@ -0,0 +1,57 @@
+import os
+from itertools import chain
+
+import torch
+from torch import nn
+
+WEIGHTS_NAME = 'weights.pt'
+# torch.load(mmap=True) needs 2.1; the meta device context and remove_duplicate=False need 2.0
+MIN_TORCH = (2, 1)
+
+
+def check_torch():
+    version = tuple(int(part) for part in torch.__version__.split('+')[0].split('.')[:2])
+    if version < MIN_TORCH:
+        raise RuntimeError('memory-mapped weights need torch >= %d.%d, found %s' % (MIN_TORCH + (torch.__version__,)))
+
+
+def save_mmap(model, save_directory):
+    """
+    Writes a model in the layout load_mmap() expects: its config plus every parameter and buffer,
+    including non-persistent buffers and tied aliases, in one zipfile-format torch.save file.
+    """
+    check_torch()
+    os.makedirs(save_directory, exist_ok=True)
+    tensors = dict(model.named_parameters(remove_duplicate=False))
+    tensors.update(model.named_buffers(remove_duplicate=False))
+    # tied aliases share a storage, which torch.save keeps shared on disk
+    torch.save({name: tensor.detach() for name, tensor in tensors.items()}, os.path.join(save_directory, WEIGHTS_NAME))
+    model.config.save_pretrained(save_directory)
+
+
+def load_mmap(model_class, save_directory):
+    """
+    Builds a transformers model from a save_mmap() directory without initializing or copying any weights.
+
+    The modules are created on the meta device and every tensor is then pointed straight at the memory-mapped
+    file, so loading costs page-table setup rather than reading and random-initializing the weights. The pages
+    are file-backed and read-only in practice, so every process that maps them shares one copy in the page cache.
+    """
+    check_torch()
+    config = model_class.config_class.from_pretrained(save_directory)
+    with torch.device('meta'):
+        model = model_class(config)
+
+    tensors = torch.load(os.path.join(save_directory, WEIGHTS_NAME), map_location='cpu', mmap=True, weights_only=True)
+    for name, tensor in tensors.items():
+        module_name, _, attr = name.rpartition('.')
+        module = model.get_submodule(module_name)
+        if attr in module._parameters:
+            module._parameters[attr] = nn.Parameter(tensor, requires_grad=False)
+        else:
+            module._buffers[attr] = tensor
+
+    missing = [name for name, tensor in chain(model.named_parameters(), model.named_buffers()) if tensor.is_meta]
+    if missing:
+        raise RuntimeError('%s has no tensor for %s' % (save_directory, ', '.join(missing)))
+    return model.eval()
@@ -0,0 +1,320 @@
+import itertools
+import multiprocessing
+import os
+import pickle
+import queue
+import signal
+import sys
+import threading
+import time
+import traceback
+from concurrent import futures
+from multiprocessing.connection import Connection, wait
+from multiprocessing.reduction import recv_handle, send_handle
+
+import torch
+
+from serving.batcher import QueueFull, RequestTimeout, collect_batch
+
+
+class ItemError(Exception):
+    """ Raised in the caller when item_fn failed on its item inside a worker. """
+    pass
+
+
+class WorkerDied(Exception):
+    """ Raised in the caller when the worker holding its item exited before answering. """
+    pass
+
+
+def share_weights(*modules):
+    """
+    Moves parameters and buffers into shared memory so forked workers map the same pages
+    instead of each holding a private copy once anything touches them.
+    """
+    for module in modules:
+        module.share_memory()
+
+
+def _dumps(value, meta):
+    # plain pickle sends tensors by value; the multiprocessing pickler would hand out a
+    # shared-memory file descriptor per tensor instead, which leaks under load
+    try:
+        return pickle.dumps((value, meta))
+    except Exception:
+        return pickle.dumps((RuntimeError(repr(value)), meta))
+
+
+def _worker_main(conn, batch_fn, item_fn, init_fn, num_threads):
+    torch.set_num_threads(num_threads)
+    if init_fn is not None:
+        init_fn()
+    # None tells the parent this worker is ready
+    conn.send_bytes(pickle.dumps(None))
+
+    while True:
+        try:
+            batch = pickle.loads(conn.recv_bytes())
+        except EOFError:
+            # the parent is gone
+            return
+        # wall-clock time, since the enqueue timestamp was taken in another process
+        started = time.time()
+
+        results = []
+        ready = []
+        for request_id, item, enqueued in batch:
+            meta = {'queue_wait': started - enqueued, 'batch_size': len(batch)}
+            try:
+                item_start = time.perf_counter()
+                if item_fn is not None:
+                    item = item_fn(item)
+                meta['item_seconds'] = time.perf_counter() - item_start
+                ready.append((request_id, item, meta))
+            except Exception as e:
+                results.append((request_id, _dumps(ItemError(str(e)), meta)))
+
+        if ready:
+            try:
+                outputs = batch_fn([item for _, item, _ in ready])
+            except Exception as e:
+                outputs = [e] * len(ready)
+            for (request_id, _, meta), output in zip(ready, outputs):
+                results.append((request_id, _dumps(output, meta)))
+        conn.send_bytes(pickle.dumps(results))
+
+
+def _zygote_main(control, parent_end, worker_args):
+    # forks a worker for every connection the parent sends; this process was forked before the parent
+    # started any thread or forward pass, so its children are too, however late they are started
+    parent_end.close()
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    while True:
+        try:
+            control.recv()
+        except EOFError:
+            return
+        fd = recv_handle(control)
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            control.close()
+            code = 0
+            try:
+                _worker_main(Connection(fd), *worker_args)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        os.close(fd)
+        control.send(pid)
+
+
+class WorkerPool:
+    """
+    Runs batch_fn in num_workers forked processes that share the parent's model weights.
+
+    The parent only accepts HTTP requests and puts items on a local queue. A dispatcher thread waits for
+    an idle worker, micro-batches waiting items exactly like MicroBatcher does and sends the batch down
+    that worker's own pipe, so requests always go to a free worker and no lock is shared between processes.
+    A caller that passes a meta dict gets queue_wait, batch_size and item_seconds (time spent in item_fn)
+    filled in.
+
+    Workers are forked from a zygote process that is itself forked when the pool is created. Create the
+    pool after the models are loaded (and ideally passed through share_weights) but before the parent
+    starts any thread or runs any forward pass: the workers then inherit the weights without copying them,
+    and torch's thread pools are still unused at fork time, also for workers started long after.
+
+    A worker that exits (crash, OOM kill) closes its pipe: the batch it held fails at once with
+    WorkerDied instead of at the timeout, and the zygote forks a replacement in its slot. A worker that
+    exits before it is ready (init_fn failed) is not replaced: error says why, and ready is set so nothing
+    waits on it forever.
+    """
+    def __init__(self, batch_fn, num_workers, item_fn=None, init_fn=None, max_batch_size=8, max_wait_ms=10, max_queue_size=256,
+                 timeout=60.0, num_threads=None, name='worker'):
+        """
+        Args:
+            batch_fn (callable): takes a list of items, returns a list of results in the same order; runs in the workers
+            num_workers (int): number of worker processes
+            item_fn (callable): applied to each item inside the worker before batching; if it raises,
+                only that item fails, with ItemError
+            init_fn (callable): run once in each worker before it takes requests, e.g. a warmup pass
+            max_batch_size (int): largest batch a worker hands to batch_fn
+            max_wait_ms (float): longest time the first item of a batch waits for company
+            max_queue_size (int): pending items beyond this are rejected with QueueFull
+            timeout (float): seconds a caller waits for its result before giving up
+            num_threads (int): torch threads per worker, defaults to an even share of the CPUs
+        """
+        if threading.active_count() > 1:
+            raise RuntimeError('WorkerPool must be created before any other thread is started, '
+                               'its workers are forked from this process')
+        num_threads = num_threads or max(1, (os.cpu_count() or 1) // num_workers)
+        self.control, zygote_end = multiprocessing.Pipe()
+        self.zygote = multiprocessing.get_context('fork').Process(
+            target=_zygote_main, name='%s-zygote' % name, daemon=True,
+            args=(zygote_end, self.control, (batch_fn, item_fn, init_fn, num_threads)))
+        self.zygote.start()
+        zygote_end.close()
+
+        self.requests = queue.Queue(maxsize=max_queue_size)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.timeout = timeout
+        self.max_queue_size = max_queue_size
+        self.name = name
+
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.request_ids = itertools.count()
+        # set once every worker is ready, or once one failed to start (then error says why)
+        self.ready = threading.Event()
+        self.error = None
+        self.restarts = 0
+
+        # (index, connection) of workers waiting for a batch; entries of replaced workers are skipped
+        self.idle = queue.Queue()
+        # request ids of the batch each worker holds
+        self.in_flight = [[] for _ in range(num_workers)]
+        self.pids = [None] * num_workers
+        # whether the worker in each slot has finished init_fn; only those are replaced when they exit
+        self.started = [False] * num_workers
+        self.connections = [self._start_worker(i) for i in range(num_workers)]
+
+        self.feeder = threading.Thread(target=self._feed, name='%s-dispatch' % name, daemon=True)
+        self.feeder.start()
+        self.collector = threading.Thread(target=self._collect, name='%s-results' % name, daemon=True)
+        self.collector.start()
+
+    def submit(self, item, meta=None):
+        request_id = next(self.request_ids)
+        future = futures.Future()
+        with self.pending_lock:
+            self.pending[request_id] = (future, meta)
+        try:
+            self.requests.put_nowait((request_id, item, time.time()))
+        except queue.Full:
+            with self.pending_lock:
+                self.pending.pop(request_id, None)
+            raise QueueFull('%d requests already waiting' % self.max_queue_size)
+
+        try:
+            return future.result(timeout=self.timeout)
+        except futures.TimeoutError:
+            # the worker may still compute it; its result is dropped on arrival
+            with self.pending_lock:
+                self.pending.pop(request_id, None)
+            raise RequestTimeout('no result after %.1fs' % self.timeout)
+
+    def alive(self):
+        # workers ready to take requests
+        return sum(conn is not None and started for conn, started in zip(self.connections, self.started))
+
+    def _start_worker(self, index):
+        # the zygote forks the worker and the parent keeps the other end of its pipe
+        conn, worker_end = multiprocessing.Pipe()
+        try:
+            self.control.send('%s-%d' % (self.name, index))
+            send_handle(self.control, worker_end.fileno(), self.zygote.pid)
+            self.pids[index] = self.control.recv()
+        finally:
+            worker_end.close()
+        return conn
+
+    def _feed(self):
+        while True:
+            index, conn = self.idle.get()
+            if self.connections[index] is not conn:
+                continue
+            batch = collect_batch(self.requests, self.max_batch_size, self.max_wait)
+            with self.pending_lock:
+                # callers that already timed out are dropped instead of being computed for nobody
+                batch = [entry for entry in batch if entry[0] in self.pending]
+            if batch:
+                self._send(batch, index, conn)
+            else:
+                self.idle.put((index, conn))
+
+    def _send(self, batch, index, conn):
+        payload = pickle.dumps(batch)
+        while True:
+            with self.pending_lock:
+                current = self.connections[index] is conn
+                if current:
+                    self.in_flight[index] = [request_id for request_id, _, _ in batch]
+            if current:
+                try:
+                    conn.send_bytes(payload)
+                except OSError:
+                    # the worker died after being picked; _collect fails its batch
+                    pass
+                return
+            # the worker was replaced while the batch was collected, take the next idle one
+            index, conn = self.idle.get()
+
+    def _collect(self):
+        while True:
+            connections = {conn: index for index, conn in enumerate(self.connections) if conn is not None}
+            if not connections:
+                print('%s: no workers left' % self.name, file=sys.stderr)
+                return
+            for conn in wait(list(connections)):
+                index = connections[conn]
+                try:
+                    message = pickle.loads(conn.recv_bytes())
+                except (EOFError, OSError):
+                    self._replace(index, conn)
+                    continue
+                if message is None:
+                    # a new or restarted worker reports ready
+                    self.started[index] = True
+                    if all(self.started):
+                        self.ready.set()
+                else:
+                    with self.pending_lock:
+                        self.in_flight[index] = []
+                    for request_id, payload in message:
+                        self._handle(request_id, payload)
+                self.idle.put((index, conn))
+
+    def _replace(self, index, conn):
+        # fails the batch of an exited worker and forks a replacement, unless it never got through init_fn:
+        # its replacement would most likely fail the same way
+        with self.pending_lock:
+            failed = [self.pending.pop(request_id, (None, None))[0] for request_id in self.in_flight[index]]
+            self.in_flight[index] = []
+            self.connections[index] = None
+        conn.close()
+        error = WorkerDied('%s-%d (pid %s) exited' % (self.name, index, self.pids[index]))
+        for future in failed:
+            if future is not None:
+                future.set_exception(error)
+        if not self.started[index]:
+            self.error = '%s before it was ready, not restarting it' % error
+            print('%s: %s' % (self.name, self.error), file=sys.stderr)
+            self.ready.set()
+            return
+        self.started[index] = False
+        try:
+            replacement = self._start_worker(index)
+        except (OSError, EOFError):
+            print('%s: cannot restart worker %d, the zygote exited' % (self.name, index), file=sys.stderr)
+            return
+        with self.pending_lock:
+            self.connections[index] = replacement
+        self.restarts += 1
+
+    def _handle(self, request_id, payload):
+        with self.pending_lock:
+            future, meta = self.pending.pop(request_id, (None, None))
+        if future is None:
+            return
+        value, worker_meta = pickle.loads(payload)
+        if meta is not None:
+            meta.update(worker_meta)
+        if isinstance(value, Exception):
+            future.set_exception(value)
+        else:
+            future.set_result(value)